@@ -0,0 +1,215 @@
+# Chess v3.2.0 Analyze
+# --------------------------------------------------------------
+# Streams the games of PGN files through the engine and writes the best move and score of every position
+# --------------------------------------------------------------
+
+import argparse
+import json
+import multiprocessing.util
+import os
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.pgn
+
+from red_chess import engine, search
+from red_chess.position import Position
+
+# Used when neither a depth nor a move time is given
+DEPTH = 3
+
+# Positions queued or being searched per worker. Games are read one at a time as the queue drains, so memory use
+# depends on this and not on the size of the files.
+QUEUE_PER_WORKER = 4
+
+
+# Reads the games of PGN files one at a time
+def read_games(paths):
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as file:
+            while True:
+                game = chess.pgn.read_game(file)
+
+                if game is None:
+                    break
+
+                yield game
+
+
+# Returns the starting FEN and the moves (as UCI) leading to every position of a game's main line
+def get_tasks(game):
+    fen = game.board().fen()
+    moves = [move.uci() for move in game.mainline_moves()]
+
+    return [(fen, moves[:ply], moves[ply]) for ply in range(len(moves))]
+
+
+# Runs when a worker process starts: loads the snapshot and saves the worker's own table to the directory when the
+# process exits, for Analysis.close to merge
+def start_worker(snapshot, directory):
+    search.load_tt(snapshot)
+    multiprocessing.util.Finalize(None, search.save_tt, args=(os.path.join(directory, str(os.getpid()) + ".bin"),),
+                                  exitpriority=10)
+
+
+# Searches one position (runs in the worker processes) and returns its annotation
+def analyze_position(fen, moves, played, depth=DEPTH, movetime=None):
+    position = Position(chess.Board(fen))
+
+    for move in moves:
+        position.push(chess.Move.from_uci(move))
+
+    best = engine.get_best_action(position, depth, movetime=movetime, threads=1)
+
+    return {
+        "ply": len(moves),
+        "fen": position.get_state().fen(),
+        "move": played,
+        "best": best.get_move().uci(),
+        "score": best.get_score(),
+        "depth": search.INFO.get_depth(),
+        "nodes": search.INFO.get_nodes()
+    }
+
+
+# Represents a pool of processes that analyzes a stream of games, keeping a bounded number of positions in flight
+# and returning the results in the order of the games. With a snapshot file the transposition table starts from it
+# and is saved back to it (merged from every worker) on close, so lines analyzed before start with deep entries.
+class Analysis:
+
+    # Searches each position to the depth, or for movetime seconds without a depth
+    def __init__(self, depth=None, movetime=None, workers=1, queue_size=None, snapshot=None):
+        if depth is None:
+            depth = DEPTH if movetime is None else engine.MAX_DEPTH
+
+        self.depth = depth
+        self.movetime = movetime
+        self.workers = workers
+        self.queue_size = workers * QUEUE_PER_WORKER if queue_size is None else queue_size
+        self.snapshot = snapshot
+        self.directory = None
+        self.executor = None
+
+        if workers > 1 and snapshot is not None:
+            self.directory = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(snapshot)))
+            self.executor = ProcessPoolExecutor(workers, initializer=start_worker,
+                                                initargs=(snapshot, self.directory.name))
+        elif workers > 1:
+            self.executor = ProcessPoolExecutor(workers)
+        elif snapshot is not None:
+            search.load_tt(snapshot)
+
+    def get_workers(self):
+        return self.workers
+
+    # Yields (game number, game, annotation) for every position of every game in order, then
+    # (game number, game, None) once all the positions of a game are done
+    def run(self, games):
+        pending = deque()
+        in_flight = 0
+
+        for number, game in enumerate(games, 1):
+            for task in get_tasks(game):
+                if self.executor is None:
+                    pending.append((number, game, analyze_position(*task, self.depth, self.movetime)))
+                else:
+                    pending.append((number, game, self.executor.submit(analyze_position, *task, self.depth,
+                                                                       self.movetime)))
+                in_flight += 1
+
+                while in_flight >= self.queue_size or pending and pending[0][2] is None:
+                    number_done, game_done, result = pending.popleft()
+
+                    if result is not None:
+                        in_flight -= 1
+
+                    yield number_done, game_done, self.get_result(result)
+
+            pending.append((number, game, None))
+
+        while pending:
+            number_done, game_done, result = pending.popleft()
+            yield number_done, game_done, self.get_result(result)
+
+    @staticmethod
+    def get_result(result):
+        return result if result is None or isinstance(result, dict) else result.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+        if self.directory is not None:
+            paths = [os.path.join(self.directory.name, name) for name in os.listdir(self.directory.name)]
+            search.merge_snapshots([self.snapshot] + paths, self.snapshot, search.TT.get_size_mb())
+            self.directory.cleanup()
+            self.directory = None
+        elif self.snapshot is not None:
+            search.save_tt(self.snapshot)
+
+        self.snapshot = None
+
+
+# Writes one JSON object per position as soon as it is analyzed
+def write_jsonl(results, output):
+    for number, game, annotation in results:
+        if annotation is not None:
+            output.write(json.dumps({"game": number, **annotation}) + "\n")
+            output.flush()
+
+
+# Writes every game with the engine's best move and score (from white's perspective) as a comment on each move
+def write_pgn(results, output):
+    annotations = []
+
+    for number, game, annotation in results:
+        if annotation is not None:
+            annotations.append(annotation)
+            continue
+
+        for node, annotation in zip(game.mainline(), annotations):
+            board = node.parent.board()
+            score = annotation["score"] if board.turn == chess.WHITE else -annotation["score"]
+            node.comment = ("best " + board.san(chess.Move.from_uci(annotation["best"])) + " " +
+                            format(score, "+.2f") + "/" + str(annotation["depth"]))
+
+        game.headers["Annotator"] = "Red Chess"
+        output.write(str(game) + "\n\n")
+        output.flush()
+        annotations = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze every position of the games in PGN files")
+    parser.add_argument("pgn", nargs="+")
+    parser.add_argument("--depth", type=int)
+    parser.add_argument("--movetime", type=float, help="seconds per position")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--format", choices=("jsonl", "pgn"), default="jsonl")
+    parser.add_argument("--output", help="file to write to instead of standard output")
+    parser.add_argument("--snapshot", help="transposition table file loaded at the start and updated at the end")
+
+    args = parser.parse_args()
+    analysis = Analysis(args.depth, args.movetime, args.workers, snapshot=args.snapshot)
+    output = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8")
+
+    try:
+        results = analysis.run(read_games(args.pgn))
+
+        if args.format == "pgn":
+            write_pgn(results, output)
+        else:
+            write_jsonl(results, output)
+    finally:
+        analysis.close()
+
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -25,7 +25,9 @@ NOTATED_RANKS = ["8", "7", "6", "5", "4", "3", "2", "1"]
 VS_COMPUTER = True
 PLAY_AS_WHITE = True
 ENGINE_DEPTH = 3
+ENGINE_MOVETIME = None
 BOOK = True
+PONDER = True
 FEN = ""
 
 app = Flask(__name__)
@@ -51,15 +53,18 @@ def main():
     selected = ()
     clicks = []
 
+    # Thinks on the player's time about the reply it expects
+    ponder = engine.Ponder() if PONDER else None
+
     if VS_COMPUTER and not PLAY_AS_WHITE:
-        engine.move(position, ENGINE_DEPTH, BOOK)
+        engine.move(position, ENGINE_DEPTH, BOOK, ENGINE_MOVETIME, ponder)
 
     while running:
         board = position.to_array()
 
         if move_made:
             if VS_COMPUTER:
-                engine.move(position, ENGINE_DEPTH, BOOK)
+                engine.move(position, ENGINE_DEPTH, BOOK, ENGINE_MOVETIME, ponder)
 
         move_made = False
 
@@ -105,7 +110,7 @@ def main():
                             if len(move) == 5:
                                 move = move[:-1] + input("Enter promotion piece: ").lower()
 
-                            position.get_state().push_uci(move)
+                            position.push(position.get_state().parse_uci(move))
 
                             move_made = True
                         except:
@@ -119,11 +124,11 @@ def main():
 
                 if e.key == pg.K_LEFT:
                     try:
-                        position.get_state().pop()
+                        position.pop()
 
                         if VS_COMPUTER:
-                            position.get_state().pop()
-                            position.get_state().pop()
+                            position.pop()
+                            position.pop()
 
                         move_made = True
                     except:
@@ -142,6 +147,9 @@ def main():
         clock.tick(MAX_FPS)
         pg.display.flip()
 
+    if ponder is not None:
+        ponder.stop()
+
 
 # Loads the piece images found in the images directory (replace filepath for custom images)
 def load_images():
@@ -0,0 +1,321 @@
+# Chess v3.2.0 Bench
+# --------------------------------------------------------------
+# Measures the speed of the engine on a fixed set of positions
+# --------------------------------------------------------------
+
+import argparse
+import json
+import sys
+import time
+
+import chess
+
+from red_chess import data, engine, ordering, search, smp
+from red_chess.evaluation import evaluate
+from red_chess.position import Position
+
+# Depth of the default run. Changing it (or the positions) changes the node signature.
+DEPTH = 4
+
+# Calls of each micro-benchmarked function per position
+MICRO_ITERATIONS = 2000
+
+# Functions timed by the micro-benchmarks
+MICRO_BENCHMARKS = {
+    "get_zobrist_hash": lambda position: position.get_zobrist_hash(),
+    "compute_zobrist_hash": lambda position: position.compute_zobrist_hash(),
+    "evaluate": evaluate,
+    "get_actions": lambda position: position.get_actions(),
+    "get_captures": lambda position: position.get_captures(),
+    "get_captures_by_see": lambda position: position.get_captures_by_see()
+}
+
+POSITIONS = {
+    "opening": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "italian": "r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4",
+    "middlegame": "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP2BPPP/R1BQK2R w KQ - 0 8",
+    "tactical": "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "endgame": "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"
+}
+
+# Positions with many pieces en prise, where quiescence search dominates the node count
+TACTICAL_POSITIONS = {
+    "wac001": "2rr3k/pp3pp1/1nnqbN1p/3pN3/2pP4/2P3Q1/PPB4P/R4RK1 w - - 0 1",
+    "wac003": "5rk1/1ppb3p/p1pb4/6q1/3P1p1r/2P1R2P/PP1BQ1P1/5RKN b - - 0 1",
+    "wac004": "r1bq2rk/pp3pbp/2p1p1pQ/7P/3P4/2PB1N2/PP3PP1/R3KR2 w Q - 0 1",
+    "wac005": "5k2/6pp/p1qN4/1p1p4/3P4/2PKP2Q/PP3r2/3R4 b - - 0 1",
+    "scotch": "r1b1k2r/ppppnppp/2n2q2/2b5/3NP3/2P1B3/PP3PPP/RN1QKB1R w KQkq - 0 1",
+    "kiwipete": "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"
+}
+
+
+# Searches every bench position to a fixed depth from an empty table and returns the nodes, time, nodes per second,
+# best move and statistics of each. The signature is the total node count: it only changes when the search
+# behaves differently, so a change meant to be a pure speedup must leave it as it is.
+def run(depth=DEPTH):
+    results = {"depth": depth, "positions": {}}
+    total_nodes = 0
+    total_time = 0
+
+    for name, fen in POSITIONS.items():
+        search.TT.clear()
+        ordering.clear()
+        stats = data.SearchStats()
+        start = time.perf_counter()
+        best = engine.get_best_action(Position(chess.Board(fen)), depth, threads=1, stats=stats)
+        elapsed = time.perf_counter() - start
+        nodes = search.INFO.get_nodes()
+
+        results["positions"][name] = {
+            "nodes": nodes,
+            "qnodes": search.INFO.get_qnodes(),
+            "time": elapsed,
+            "nps": int(nodes / elapsed),
+            "move": best.get_move().uci(),
+            "score": best.get_score(),
+            "tt_hit_rate": stats.get_tt_hit_rate(),
+            "first_move_cutoff_rate": stats.get_first_move_cutoff_rate()
+        }
+        total_nodes += nodes
+        total_time += elapsed
+
+        print(name.ljust(10) + "  nodes " + str(nodes).rjust(8) + "  nps " + str(int(nodes / elapsed)).rjust(7) +
+              "  time " + str(round(elapsed, 3)).rjust(7) + "s  move " + best.get_move().uci() +
+              "  score " + str(best.get_score()))
+
+    results["nodes"] = total_nodes
+    results["time"] = total_time
+    results["nps"] = int(total_nodes / total_time)
+    results["signature"] = total_nodes
+
+    print("total       nodes " + str(total_nodes).rjust(8) + "  nps " + str(results["nps"]).rjust(7) +
+          "  time " + str(round(total_time, 3)).rjust(7) + "s  signature " + str(total_nodes))
+
+    return results
+
+
+# Times each micro-benchmarked function over every bench position and returns nanoseconds per call
+def micro(iterations=MICRO_ITERATIONS):
+    positions = [Position(chess.Board(fen)) for fen in POSITIONS.values()]
+    results = {}
+
+    for name, function in MICRO_BENCHMARKS.items():
+        start = time.perf_counter()
+
+        for position in positions:
+            for i in range(iterations):
+                function(position)
+
+        results[name] = (time.perf_counter() - start) / (iterations * len(positions)) * 1e9
+
+        print(name.ljust(20) + str(round(results[name])).rjust(9) + " ns/call")
+
+    return results
+
+
+# Compares results with a baseline and returns False if the node signature changed
+def compare(results, baseline):
+    unchanged = results["signature"] == baseline["signature"]
+
+    print("signature " + str(results["signature"]) + " baseline " + str(baseline["signature"]) +
+          ("  same" if unchanged else "  CHANGED"))
+
+    for name, result in results["positions"].items():
+        if name in baseline["positions"]:
+            before = baseline["positions"][name]
+            print(name.ljust(10) + "  nodes " + str(before["nodes"]) + " -> " + str(result["nodes"]) +
+                  "  nps " + format_change(before["nps"], result["nps"]))
+
+    print("total       nps " + format_change(baseline["nps"], results["nps"]))
+
+    for name, nanoseconds in results.get("micro", {}).items():
+        if name in baseline.get("micro", {}):
+            print(name.ljust(20) + " ns/call " + format_change(baseline["micro"][name], nanoseconds))
+
+    return unchanged
+
+
+def format_change(before, after):
+    change = (after - before) / before * 100
+
+    return str(round(before)) + " -> " + str(round(after)) + " (" + format(change, "+.1f") + "%)"
+
+
+# Searches every bench position to a fixed depth with 1 to max_workers processes and prints the total nodes,
+# nodes per second and time to depth of each worker count
+def smp_scaling(max_workers, depth):
+    results = []
+
+    for workers in range(1, max_workers + 1):
+        nodes = 0
+        start = time.perf_counter()
+
+        for fen in POSITIONS.values():
+            search.TT.clear()
+
+            if workers > 1:
+                smp.get_pool(workers).clear()
+
+            engine.get_best_action(Position(chess.Board(fen)), depth, threads=workers)
+            nodes += search.INFO.get_nodes()
+
+        elapsed = time.perf_counter() - start
+        results.append((workers, nodes, elapsed))
+
+        print("workers " + str(workers) + "  nodes " + str(nodes) + "  nps " + str(int(nodes / elapsed)) +
+              "  time to depth " + str(depth) + " " + str(round(elapsed, 2)) + "s" +
+              "  speedup " + str(round(results[0][2] / elapsed, 2)))
+
+    return results
+
+
+# Searches every bench and tactical position to a fixed depth from empty tables with one process (late-move
+# reductions set as in the root splitting workers), then with root splitting, and prints the nodes, time, move and
+# score of each. Returns the number of positions where the move or score differs.
+def split_check(workers, depth):
+    mismatches = 0
+    search.LMR = smp.SPLIT_LMR
+
+    for name, fen in {**POSITIONS, **TACTICAL_POSITIONS}.items():
+        results = []
+
+        for threads in (1, workers):
+            search.TT.clear()
+            ordering.clear()
+            start = time.perf_counter()
+            best = engine.get_best_action(Position(chess.Board(fen)), depth, threads=threads, mode="split")
+            results.append((best.get_move(), best.get_score()))
+
+            print(("split " if threads > 1 else "serial") + "  " + name.ljust(10) + "  nodes " +
+                  str(search.INFO.get_nodes()) + "  time " + str(round(time.perf_counter() - start, 2)) +
+                  "s  move " + best.get_move().uci() + "  score " + str(best.get_score()))
+
+        if results[0] != results[1]:
+            mismatches += 1
+            print("mismatch  " + name)
+
+    search.LMR = True
+
+    print("mismatches " + str(mismatches))
+
+    return mismatches
+
+
+# Searches every bench position for a fixed time with null-move pruning and late-move reductions off, then on,
+# and prints the depth reached and nodes searched by each
+def selectivity(movetime):
+    results = {}
+
+    for enabled in (False, True):
+        search.NULL_MOVE = search.LMR = enabled
+        label = "on " if enabled else "off"
+        results[enabled] = []
+
+        for name, fen in POSITIONS.items():
+            search.TT.clear()
+            ordering.clear()
+            best = engine.get_best_action(Position(chess.Board(fen)), movetime=movetime)
+            results[enabled].append(search.INFO.get_depth())
+
+            print("selective " + label + "  " + name.ljust(10) + "  depth " + str(search.INFO.get_depth()) +
+                  "  nodes " + str(search.INFO.get_nodes()) + "  move " + best.get_move().uci() +
+                  "  score " + str(best.get_score()))
+
+    search.NULL_MOVE = search.LMR = True
+
+    print("average depth  off " + str(sum(results[False]) / len(POSITIONS)) +
+          "  on " + str(sum(results[True]) / len(POSITIONS)))
+
+    return results
+
+
+# Searches every tactical position to a fixed depth with SEE and delta pruning in quiescence search off, then on,
+# and prints the quiescence nodes, total nodes and time of each
+def quiescence(depth):
+    results = {}
+
+    for enabled in (False, True):
+        search.SEE_PRUNING = search.DELTA_PRUNING = enabled
+        label = "on " if enabled else "off"
+        results[enabled] = 0
+
+        for name, fen in TACTICAL_POSITIONS.items():
+            search.TT.clear()
+            ordering.clear()
+            start = time.perf_counter()
+            best = engine.get_best_action(Position(chess.Board(fen)), depth)
+            results[enabled] += search.INFO.get_qnodes()
+
+            print("pruning " + label + "  " + name.ljust(10) + "  qnodes " + str(search.INFO.get_qnodes()) +
+                  "  nodes " + str(search.INFO.get_nodes()) + "  time " + str(round(time.perf_counter() - start, 2)) +
+                  "s  move " + best.get_move().uci() + "  score " + str(best.get_score()))
+
+    search.SEE_PRUNING = search.DELTA_PRUNING = True
+
+    print("total qnodes  off " + str(results[False]) + "  on " + str(results[True]) +
+          "  reduction " + str(round(results[False] / max(results[True], 1), 2)) + "x")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Engine benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Fixed depth search of every bench position and micro-benchmarks "
+                                                   "(the default)")
+    run_parser.add_argument("--depth", type=int, default=DEPTH)
+    run_parser.add_argument("--iterations", type=int, default=MICRO_ITERATIONS, help="0 skips the micro-benchmarks")
+    run_parser.add_argument("--output", help="JSON file to write the results to")
+    run_parser.add_argument("--baseline", help="JSON results of an earlier run to compare with (the exit status is 1 "
+                                               "if the node signature changed)")
+
+    smp_parser = subparsers.add_parser("smp", help="Lazy SMP scaling from 1 to N worker processes")
+    smp_parser.add_argument("--workers", type=int, default=4)
+    smp_parser.add_argument("--depth", type=int, default=4)
+
+    selectivity_parser = subparsers.add_parser("selectivity", help="Depth reached in a fixed time without and with "
+                                                                   "null-move pruning and late-move reductions")
+    selectivity_parser.add_argument("--movetime", type=float, default=5)
+
+    split_parser = subparsers.add_parser("split", help="Root splitting against one process from empty tables (the "
+                                                       "exit status is 1 if any move or score differs)")
+    split_parser.add_argument("--workers", type=int, default=2)
+    split_parser.add_argument("--depth", type=int, default=4)
+
+    quiescence_parser = subparsers.add_parser("quiescence", help="Quiescence nodes on tactical positions without "
+                                                                 "and with SEE and delta pruning")
+    quiescence_parser.add_argument("--depth", type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        args = parser.parse_args(["run"])
+
+    if args.command == "run":
+        results = run(args.depth)
+
+        if args.iterations:
+            results["micro"] = micro(args.iterations)
+
+        if args.output is not None:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=4)
+
+        if args.baseline is not None:
+            with open(args.baseline) as file:
+                if not compare(results, json.load(file)):
+                    sys.exit(1)
+    elif args.command == "smp":
+        smp_scaling(args.workers, args.depth)
+    elif args.command == "split":
+        if split_check(args.workers, args.depth):
+            sys.exit(1)
+    elif args.command == "selectivity":
+        selectivity(args.movetime)
+    elif args.command == "quiescence":
+        quiescence(args.depth)
+
+
+if __name__ == "__main__":
+    main()
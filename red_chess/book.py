@@ -0,0 +1,148 @@
+# Chess v3.2.0 Book
+# --------------------------------------------------------------
+# Opening book service that keeps polyglot books memory mapped and probes all of them in one lookup
+# --------------------------------------------------------------
+
+import mmap
+import os
+import random
+
+import chess
+from chess import polyglot
+import numpy as np
+
+from red_chess.position import Position
+
+BOOK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "openings")
+
+# Layout of a polyglot entry (big endian): key, move, weight, learn
+ENTRY = np.dtype([("key", ">u8"), ("move", ">u2"), ("weight", ">u2"), ("learn", ">u4")])
+
+
+# Decodes a polyglot move, which encodes castling as the king capturing its own rook
+def decode_move(board, raw):
+    from_square = raw >> 6 & 63
+    to_square = raw & 63
+    promotion = raw >> 12 & 7
+
+    if board.piece_type_at(from_square) == chess.KING and board.color_at(to_square) == board.turn:
+        to_square = chess.square(6 if to_square > from_square else 2, chess.square_rank(from_square))
+
+    return chess.Move(from_square, to_square, promotion + 1 if promotion else None)
+
+
+# Encodes a move the polyglot way (castling as the king capturing its own rook)
+def encode_move(board, move):
+    to_square = move.to_square
+
+    if board.is_castling(move):
+        to_square = chess.square(7 if to_square > move.from_square else 0, chess.square_rank(move.from_square))
+
+    return (move.promotion - 1 if move.promotion else 0) << 12 | move.from_square << 6 | to_square
+
+
+# Represents every available opening book, opened once and probed through a merged, sorted key index
+class OpeningBook:
+
+    def __init__(self, names, directory=BOOK_DIRECTORY):
+        self.names = []
+        self.files = []
+        self.maps = []
+        self.entries = []
+
+        keys = []
+        books = []
+        offsets = []
+
+        for name in names:
+            path = os.path.join(directory, name + ".bin")
+
+            if not os.path.isfile(path) or os.path.getsize(path) < ENTRY.itemsize:
+                continue
+
+            file = open(path, "rb")
+            book_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            entries = np.frombuffer(book_map, ENTRY, len(book_map) // ENTRY.itemsize)
+
+            keys.append(entries["key"].astype(np.uint64))
+            books.append(np.full(len(entries), len(self.entries), np.uint8))
+            offsets.append(np.arange(len(entries), dtype=np.uint32))
+
+            self.names.append(name)
+            self.files.append(file)
+            self.maps.append(book_map)
+            self.entries.append(entries)
+
+        if keys:
+            keys = np.concatenate(keys)
+            order = np.argsort(keys, kind="stable")
+            self.keys = keys[order]
+            self.books = np.concatenate(books)[order]
+            self.offsets = np.concatenate(offsets)[order]
+        else:
+            self.keys = np.empty(0, np.uint64)
+            self.books = np.empty(0, np.uint8)
+            self.offsets = np.empty(0, np.uint32)
+
+    def __str__(self):
+        return "OpeningBook(" + ", ".join(self.names) + ": " + str(len(self.keys)) + " entries)"
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_names(self):
+        return self.names
+
+    # Returns the legal book moves of a position with their weights summed over all books. A Position's own
+    # hash is the polyglot key (unless position.set_zobrist_seed replaced the table), so only boards are hashed here.
+    def get_moves(self, position):
+        if isinstance(position, Position):
+            board = position.get_state()
+            key = np.uint64(position.get_zobrist_hash())
+        else:
+            board = position
+            key = np.uint64(polyglot.zobrist_hash(board))
+        start = np.searchsorted(self.keys, key, "left")
+        end = np.searchsorted(self.keys, key, "right")
+        moves = {}
+
+        for i in range(start, end):
+            entry = self.entries[self.books[i]][self.offsets[i]]
+            move = decode_move(board, int(entry["move"]))
+
+            if board.is_legal(move):
+                moves[move] = moves.get(move, 0) + int(entry["weight"])
+
+        return moves
+
+    # Picks a book move at random in proportion to its weight (null move if the position isn't in any book)
+    def weighted_choice(self, position, generator=random):
+        moves = self.get_moves(position)
+        total = sum(moves.values())
+
+        if not moves:
+            return chess.Move.null()
+        if total == 0:
+            return generator.choice(list(moves))
+
+        choice = generator.uniform(0, total)
+
+        for move, weight in moves.items():
+            choice -= weight
+
+            if choice <= 0:
+                return move
+
+        return move
+
+    def close(self):
+        self.entries = []
+
+        for book_map in self.maps:
+            book_map.close()
+
+        for file in self.files:
+            file.close()
+
+        self.maps = []
+        self.files = []
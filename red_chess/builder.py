@@ -0,0 +1,181 @@
+# Chess v3.2.0 Builder
+# --------------------------------------------------------------
+# Compiles PGN game collections into a polyglot opening book that OpeningBook can read
+# --------------------------------------------------------------
+
+import argparse
+import heapq
+import os
+import tempfile
+
+import numpy as np
+
+from red_chess.analyze import read_games
+from red_chess.book import BOOK_DIRECTORY, ENTRY, encode_move
+from red_chess.position import Position
+
+# Book moves are only collected up to this ply
+MAX_PLY = 24
+
+# Moves played in fewer games are left out of the book
+MIN_GAMES = 2
+
+# Number of (position, move) records collected before they are sorted and written to a temporary run file
+BUFFER_SIZE = 1 << 20
+
+# Number of records read at a time from each run while merging
+READ_SIZE = 1 << 14
+
+# Layout of the temporary runs: polyglot key, polyglot move, points (2 per win and 1 per draw) and games
+RECORD = np.dtype([("key", "<u8"), ("move", "<u2"), ("points", "<u4"), ("games", "<u4")])
+
+# Points scored by white for each result
+RESULTS = {
+    "1-0": 2,
+    "1/2-1/2": 1,
+    "0-1": 0
+}
+
+
+# Yields (key, move, points, games) for every move of a game up to the ply limit, with points from the perspective
+# of the side making the move. Games without a result are skipped.
+def get_records(game, max_ply=MAX_PLY):
+    points = RESULTS.get(game.headers.get("Result"))
+
+    if points is None:
+        return
+
+    position = Position(game.board())
+
+    for ply, move in enumerate(game.mainline_moves()):
+        if ply >= max_ply:
+            break
+
+        state = position.get_state()
+
+        yield position.get_zobrist_hash(), encode_move(state, move), points if state.turn else 2 - points, 1
+        position.push(move)
+
+
+# Sorts a buffer of records, adds up the records of the same position and move, and writes them to a new run file
+def write_run(records, directory):
+    records = np.sort(records, order=("key", "move"))
+    starts = np.flatnonzero(np.concatenate(([True], (records["key"][1:] != records["key"][:-1]) |
+                                            (records["move"][1:] != records["move"][:-1]))))
+    run = records[starts]
+    run["points"] = np.add.reduceat(records["points"], starts)
+    run["games"] = np.add.reduceat(records["games"], starts)
+
+    file = tempfile.NamedTemporaryFile(dir=directory, suffix=".run", delete=False)
+    run.tofile(file)
+    file.close()
+
+    return file.name
+
+
+# Reads the records of a run file a block at a time
+def read_run(path):
+    run = np.memmap(path, RECORD, "r")
+
+    for start in range(0, len(run), READ_SIZE):
+        for key, move, points, games in run[start:start + READ_SIZE].tolist():
+            yield key, move, points, games
+
+    del run
+
+
+# Sorts the records of all games into run files of at most buffer_size records each
+def write_runs(games, directory, max_ply=MAX_PLY, buffer_size=BUFFER_SIZE):
+    buffer = np.empty(buffer_size, RECORD)
+    paths = []
+    count = 0
+
+    for game in games:
+        for record in get_records(game, max_ply):
+            buffer[count] = record
+            count += 1
+
+            if count == buffer_size:
+                paths.append(write_run(buffer, directory))
+                count = 0
+
+    if count:
+        paths.append(write_run(buffer[:count], directory))
+
+    return paths
+
+
+# Merges the sorted runs and yields (key, [(move, points, games), ...]) for every position in key order
+def merge_runs(paths):
+    key = None
+    moves = {}
+
+    for record_key, move, points, games in heapq.merge(*(read_run(path) for path in paths)):
+        if record_key != key:
+            if moves:
+                yield key, moves
+
+            key = record_key
+            moves = {}
+
+        total_points, total_games = moves.get(move, (0, 0))
+        moves[move] = (total_points + points, total_games + games)
+
+    if moves:
+        yield key, moves
+
+
+# Returns the book entries of a position, best first. The weight is the points scored with the move (so it grows
+# with both how often it was played and how well it did), scaled down to fit 16 bits if needed. Moves left with
+# weight 0 (never scored) are left out, as polyglot readers skip them anyway.
+def get_entries(key, moves, min_games=MIN_GAMES):
+    moves = [(points, move) for move, (points, games) in moves.items() if games >= min_games]
+    scale = max([points for points, move in moves] + [65535]) / 65535
+    entries = [(key, move, int(points / scale), 0) for points, move in sorted(moves, reverse=True)]
+
+    return [entry for entry in entries if entry[2] > 0]
+
+
+# Streams the games of PGN files into a sorted polyglot book and returns the number of entries written.
+# Only one buffer of records and one block per run are held in memory, so inputs can be far larger than RAM.
+def build(pgn_paths, output, max_ply=MAX_PLY, min_games=MIN_GAMES, buffer_size=BUFFER_SIZE, temp_directory=None):
+    count = 0
+
+    with tempfile.TemporaryDirectory(dir=temp_directory) as directory:
+        paths = write_runs(read_games(pgn_paths), directory, max_ply, buffer_size)
+
+        with open(output, "wb") as file:
+            block = []
+
+            for key, moves in merge_runs(paths):
+                block += get_entries(key, moves, min_games)
+
+                if len(block) >= READ_SIZE:
+                    np.array(block, ENTRY).tofile(file)
+                    count += len(block)
+                    block = []
+
+            if block:
+                np.array(block, ENTRY).tofile(file)
+                count += len(block)
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a polyglot opening book from PGN files")
+    parser.add_argument("pgn", nargs="+")
+    parser.add_argument("--output", default=os.path.join(BOOK_DIRECTORY, "custom.bin"))
+    parser.add_argument("--max-ply", type=int, default=MAX_PLY)
+    parser.add_argument("--min-games", type=int, default=MIN_GAMES)
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE, help="records sorted in memory at a time")
+    parser.add_argument("--temp-directory", help="directory for the temporary sorted runs")
+
+    args = parser.parse_args()
+    count = build(args.pgn, args.output, args.max_ply, args.min_games, args.buffer_size, args.temp_directory)
+
+    print(str(count) + " entries written to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
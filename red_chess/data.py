@@ -1,21 +1,27 @@
 # Chess v3.2.0 Data
 # --------------------------------------------------------------
-# Data structures for use in the transposition table
+# Data structures for use in the search and the transposition table
 # --------------------------------------------------------------
 
+import inspect
+import math
+import os
+import time
+
+import chess
+import numpy as np
+
+
 # Contains a move and its score
 class Entry:
+    __slots__ = ("move", "score")
 
     def __init__(self, move, score):
         self.move = move
         self.score = score
-        self.data = {
-            "move": self.move,
-            "score": self.score
-        }
 
     def __str__(self):
-        return str(self.data)
+        return str(self.get_data())
 
     def get_move(self):
         return self.move
@@ -24,15 +30,16 @@ class Entry:
         return self.score
 
     def get_data(self):
-        return self.data
+        return {
+            "move": self.move,
+            "score": self.score
+        }
 
     def set_move(self, move):
         self.move = move
-        self.data["move"] = move
 
     def set_score(self, score):
         self.score = score
-        self.data["score"] = score
 
 
 # Represents a single entry in the transposition table
@@ -42,20 +49,17 @@ class Transposition:
     LOWER_BOUND = 1
     UPPER_BOUND = 2
 
+    __slots__ = ("flag", "entry", "depth")
+
     def __init__(self, flag, entry, depth):
         self.flag = flag
         self.entry = entry
         self.depth = depth
-        self.data = {
-            "flag": self.flag,
-            "entry": self.entry,
-            "depth": self.depth
-        }
 
     def __str__(self):
         s = ""
 
-        for key, value in self.data.items():
+        for key, value in self.get_data().items():
             s += str(key) + ': ' + str(value) + "\n"
 
         return "\n" + s
@@ -70,46 +74,391 @@ class Transposition:
         return self.depth
 
     def get_data(self):
-        return self.data
+        return {
+            "flag": self.flag,
+            "entry": self.entry,
+            "depth": self.depth
+        }
 
     def set_flag(self, flag):
         self.flag = flag
-        self.data["flag"] = flag
 
     def set_entry(self, entry):
         self.entry = entry
-        self.data["entry"] = entry
 
     def set_depth(self, depth):
         self.depth = depth
-        self.data["depth"] = depth
 
 
-# Represents the transposition table
+# Packs a move into 16 bits (from square, to square and promotion piece)
+def encode_move(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(bits):
+    return chess.Move(bits & 63, bits >> 6 & 63, bits >> 12 or None)
+
+
+# Represents the transposition table as a fixed number of buckets stored in one uint64 array.
+# Each bucket has a depth-preferred slot and an always-replace slot, and each slot is two words:
+# the key XORed with the data, and the data itself (move, score, depth, flag and age packed together).
+# Snapshots are the array behind a header of SNAPSHOT_HEADER_WORDS words: the magic number, the layout version,
+# the zobrist scheme and evaluation version the entries were made with, the age and the number of table words.
 class TranspositionTable:
+    DEFAULT_SIZE_MB = 64
+    BUCKET_SLOTS = 2
+    SLOT_WORDS = 2
+    SCORE_SCALE = 100
+    SCORE_OFFSET = 2 ** 31
+    MAX_AGE = 64
+
+    SNAPSHOT_MAGIC = int.from_bytes(b"REDCHSTT", "little")
+    SNAPSHOT_LAYOUT = 1
+    SNAPSHOT_HEADER_WORDS = 8
 
-    def __init__(self, transpositions=None):
-        if transpositions is None:
-            transpositions = {}
+    def __init__(self, size_mb=DEFAULT_SIZE_MB):
+        self.size_mb = size_mb
+        self.age = 0
+        self.buckets = 0
+        self.mask = 0
+        self.table = None
+        self.slots = None
 
-        self.transpositions = transpositions
+        self.resize(size_mb)
 
     def __str__(self):
-        s = ""
+        return "TranspositionTable(" + str(self.size_mb) + " MB, " + str(self.buckets) + " buckets, " + \
+               str(round(self.get_usage() * 100, 1)) + "% used)"
+
+    def get_size_mb(self):
+        return self.size_mb
+
+    def get_age(self):
+        return self.age
+
+    # Fraction of slots that hold an entry
+    def get_usage(self):
+        return np.count_nonzero(self.table[1::TranspositionTable.SLOT_WORDS]) / len(self.slots) * 2
 
-        for key, value in self.get_transpositions().items():
-            s += str(key) + ": " + str(value)
+    # Number of bytes used by a table of size_mb (the bucket count is rounded down to a power of two)
+    @staticmethod
+    def get_table_bytes(size_mb):
+        bucket_bytes = TranspositionTable.BUCKET_SLOTS * TranspositionTable.SLOT_WORDS * 8
+        buckets = max(1, int(size_mb * 2 ** 20) // bucket_bytes)
 
-        return s
+        return (1 << (buckets.bit_length() - 1)) * bucket_bytes
 
-    def get_transpositions(self):
-        return self.transpositions
+    # Reallocates the table with the largest power of two bucket count that fits in size_mb (clears all entries)
+    def resize(self, size_mb):
+        self.use(np.zeros(TranspositionTable.get_table_bytes(size_mb) // 8, np.uint64))
+        self.size_mb = size_mb
+
+    # Uses an external buffer (e.g. multiprocessing shared memory) as the table so several processes can share it.
+    # Slots are written without locks: a slot torn by two concurrent writes fails the key check and reads as a miss.
+    def attach(self, buffer):
+        self.use(np.ndarray(TranspositionTable.get_table_bytes(len(buffer) / 2 ** 20) // 8, np.uint64, buffer))
+
+    def use(self, table):
+        buckets = len(table) // (TranspositionTable.BUCKET_SLOTS * TranspositionTable.SLOT_WORDS)
+
+        self.size_mb = len(table) * 8 / 2 ** 20
+        self.buckets = buckets
+        self.mask = buckets - 1
+        self.table = table
+        self.slots = memoryview(table).cast("B").cast("Q")
+
+    def clear(self):
+        self.table.fill(0)
+        self.age = 0
+
+    def set_age(self, age):
+        self.age = age % TranspositionTable.MAX_AGE
+
+    # Starts a new generation so entries from previous searches are replaced first
+    def new_search(self):
+        self.age = (self.age + 1) % TranspositionTable.MAX_AGE
 
     def get(self, key):
+        slots = self.slots
+        i = (key & self.mask) << 2
+
+        data = slots[i + 1]
+
+        if data and slots[i] ^ data == key:
+            return self.unpack(data)
+
+        data = slots[i + 3]
+
+        if data and slots[i + 2] ^ data == key:
+            return self.unpack(data)
+
+        return None
+
+    def store(self, key, move, score, depth, flag):
+        slots = self.slots
+        i = (key & self.mask) << 2
+        old = slots[i + 1]
+
+        if old and slots[i] ^ old != key and old >> 58 == self.age and depth < (old >> 48 & 255):
+            i += 2
+
+        data = self.pack(move, score, depth, flag)
+        slots[i] = key ^ data
+        slots[i + 1] = data
+
+    # Returns the keys and data words of the entries stored in a table array
+    @staticmethod
+    def get_entries(table):
+        data = table[1::TranspositionTable.SLOT_WORDS]
+        used = data != 0
+
+        return (table[0::TranspositionTable.SLOT_WORDS] ^ data)[used], data[used]
+
+    # Adds entries to the table. Of the entries already in a bucket and the new ones that map to it (the deepest one
+    # of each key), the deepest goes in the depth-preferred slot and the next deepest in the always-replace slot.
+    def merge(self, keys, data):
+        old_keys, old_data = TranspositionTable.get_entries(self.table)
+        keys = np.concatenate((old_keys, keys))
+        data = np.concatenate((old_data, data))
+        shallowness = 255 - (data >> 48 & 255)
+
+        order = np.lexsort((shallowness, keys))
+        keys, data, shallowness = keys[order], data[order], shallowness[order]
+        first = np.concatenate(([True], keys[1:] != keys[:-1]))
+        keys, data, shallowness = keys[first], data[first], shallowness[first]
+
+        buckets = keys & self.mask
+        order = np.lexsort((shallowness, buckets))
+        keys, data, buckets = keys[order], data[order], buckets[order]
+        starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+        rank = np.arange(len(buckets)) - np.repeat(starts, np.diff(np.append(starts, len(buckets))))
+        kept = rank < TranspositionTable.BUCKET_SLOTS
+
+        slots = (buckets[kept] * TranspositionTable.BUCKET_SLOTS + rank[kept].astype(np.uint64)) * \
+            TranspositionTable.SLOT_WORDS
+        self.table.fill(0)
+        self.table[slots] = keys[kept] ^ data[kept]
+        self.table[slots + 1] = data[kept]
+
+    # Writes the table to a snapshot file. The file is written next to the path and then renamed over it, so
+    # readers never see half a snapshot.
+    def save(self, path, scheme, evaluation):
+        header = [TranspositionTable.SNAPSHOT_MAGIC, TranspositionTable.SNAPSHOT_LAYOUT, scheme, evaluation, self.age,
+                  len(self.table)]
+        words = TranspositionTable.SNAPSHOT_HEADER_WORDS
+        temporary = path + "." + str(os.getpid()) + ".tmp"
+
+        snapshot = np.memmap(temporary, np.uint64, "w+", shape=words + len(self.table))
+        snapshot[:len(header)] = header
+        snapshot[words:] = self.table
+        snapshot.flush()
+        del snapshot
+
+        os.replace(temporary, path)
+
+    # Returns the age and the memory mapped table words of a snapshot file, or None if it is missing or was written
+    # with another layout, zobrist scheme or evaluation
+    @staticmethod
+    def read_snapshot(path, scheme, evaluation):
         try:
-            return self.transpositions[key]
-        except KeyError:
-            return Transposition(Transposition.NOT_PRESENT, None, 0)
+            snapshot = np.memmap(path, np.uint64, "r")
+        except (OSError, ValueError):
+            return None
+
+        words = TranspositionTable.SNAPSHOT_HEADER_WORDS
+        header = [TranspositionTable.SNAPSHOT_MAGIC, TranspositionTable.SNAPSHOT_LAYOUT, scheme, evaluation]
+
+        if len(snapshot) < words or snapshot[:len(header)].tolist() != header or \
+                int(snapshot[5]) != len(snapshot) - words:
+            return None
+
+        return int(snapshot[4]), snapshot[words:]
+
+    # Loads the entries of a snapshot file and returns whether it could be used. A snapshot of the same size as
+    # an empty table is copied as it is, anything else is merged with the entries already in the table.
+    def load(self, path, scheme, evaluation):
+        snapshot = TranspositionTable.read_snapshot(path, scheme, evaluation)
+
+        if snapshot is None:
+            return False
+
+        age, table = snapshot
+
+        if len(table) == len(self.table) and not self.table.any():
+            self.table[:] = table
+            self.set_age(age)
+        else:
+            self.merge(*TranspositionTable.get_entries(table))
+
+        return True
+
+    def pack(self, move, score, depth, flag):
+        score = round(score * TranspositionTable.SCORE_SCALE) + TranspositionTable.SCORE_OFFSET
+        score = min(max(score, 1), 2 ** 32 - 1)
+
+        return encode_move(move) | score << 16 | min(max(depth, 0), 255) << 48 | flag << 56 | self.age << 58
+
+    @staticmethod
+    def unpack(data):
+        score = ((data >> 16 & 0xFFFFFFFF) - TranspositionTable.SCORE_OFFSET) / TranspositionTable.SCORE_SCALE
+
+        return Transposition(data >> 56 & 3, Entry(decode_move(data & 0xFFFF), score), data >> 48 & 255)
+
+
+# Tracks the node count and the limits of the running search
+class SearchInfo:
+    # The clock is checked every 1024 nodes
+    CHECK_MASK = 1023
+
+    def __init__(self):
+        self.nodes = 0
+        self.qnodes = 0
+        self.depth = 0
+        self.start_time = time.perf_counter()
+        self.deadline = math.inf
+        self.stopped = False
+        self.stop_event = None
+
+    def get_nodes(self):
+        return self.nodes
+
+    # Quiescence nodes (also counted in nodes)
+    def get_qnodes(self):
+        return self.qnodes
+
+    # Deepest fully searched iteration
+    def get_depth(self):
+        return self.depth
+
+    def get_elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def get_deadline(self):
+        return self.deadline
+
+    # Resets the counters for a new search that must finish before the deadline (a perf_counter time)
+    def start(self, deadline=math.inf):
+        self.nodes = 0
+        self.qnodes = 0
+        self.depth = 0
+        self.start_time = time.perf_counter()
+        self.deadline = deadline
+        self.stopped = False
+
+    def set_depth(self, depth):
+        self.depth = depth
+
+    def set_deadline(self, deadline):
+        self.deadline = deadline
+
+    def set_nodes(self, nodes):
+        self.nodes = nodes
+
+    # Also stop when an event shared with other processes is set (see smp.py)
+    def set_stop_event(self, stop_event):
+        self.stop_event = stop_event
+
+    def stop(self):
+        self.stopped = True
+
+    def is_stopped(self):
+        if not self.stopped and time.perf_counter() >= self.deadline:
+            self.stopped = True
+
+        if not self.stopped and self.stop_event is not None and self.stop_event.is_set():
+            self.stopped = True
+
+        return self.stopped
+
+
+# Opt-in search statistics: counters per ply from the root (the root moves lead to ply 1) and, with timing on,
+# the calls and seconds spent in the functions the search relies on (see search.set_stats)
+class SearchStats:
+    MAX_PLY = 128
+
+    COUNTERS = ("nodes", "qnodes", "tt_probes", "tt_hits", "tt_stores", "cutoffs", "first_move_cutoffs",
+                "null_move_cutoffs", "evaluations")
+
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.timings = {}
+
+        for name in SearchStats.COUNTERS:
+            setattr(self, name, [0] * SearchStats.MAX_PLY)
+
+    def is_timing(self):
+        return self.timing
+
+    # Returns the counters of every ply that was reached, as a list of dicts
+    def get_plies(self):
+        plies = [{name: getattr(self, name)[ply] for name in SearchStats.COUNTERS}
+                 for ply in range(SearchStats.MAX_PLY)]
+
+        while plies and not plies[-1]["nodes"] and not plies[-1]["qnodes"]:
+            plies.pop()
+
+        return plies
+
+    def get_totals(self):
+        return {name: sum(getattr(self, name)) for name in SearchStats.COUNTERS}
+
+    def get_tt_hit_rate(self):
+        return sum(self.tt_hits) / max(sum(self.tt_probes), 1)
+
+    # Share of beta cutoffs caused by the first move searched, a measure of move ordering
+    def get_first_move_cutoff_rate(self):
+        return sum(self.first_move_cutoffs) / max(sum(self.cutoffs), 1)
+
+    # Returns the calls, total seconds and microseconds per call of every timed function
+    def get_timings(self):
+        return {
+            name: {
+                "calls": calls,
+                "seconds": seconds,
+                "us_per_call": seconds / calls * 1000000 if calls else 0
+            } for name, (calls, seconds) in self.timings.items()
+        }
+
+    def to_dict(self):
+        return {
+            "totals": self.get_totals(),
+            "tt_hit_rate": self.get_tt_hit_rate(),
+            "first_move_cutoff_rate": self.get_first_move_cutoff_rate(),
+            "plies": self.get_plies(),
+            "timings": self.get_timings()
+        }
+
+    # Wraps a function so its calls and time are added to the timings under the given name. For a generator
+    # function, each generator counts as one call and the time is spent producing its items.
+    def timed(self, name, function):
+        timing = self.timings.setdefault(name, [0, 0.0])
+
+        def generator_wrapper(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            timing[0] += 1
+
+            while True:
+                start = time.perf_counter()
+
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    timing[1] += time.perf_counter() - start
+
+                yield item
+
+        if inspect.isgeneratorfunction(function):
+            return generator_wrapper
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timing[0] += 1
+                timing[1] += time.perf_counter() - start
 
-    def store(self, key, transposition):
-        self.transpositions[key] = transposition
+        return wrapper
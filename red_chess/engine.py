@@ -4,126 +4,389 @@
 # --------------------------------------------------------------
 
 import math
+import random
+import threading
+import time
 import chess
-from chess import polyglot, gaviota
-from red_chess import data
+from red_chess import data, ordering, smp
+from red_chess.book import OpeningBook
 from red_chess.position import Position
-from red_chess.search import negamax
+from red_chess import search
+from red_chess.search import negamax, INFO, MATE_BOUND, SCOUT_WINDOW, SearchTimeout, TABLEBASE, TT
 
-# Used for the opening book (change filepath for custom opening book )
-BOOKS = ["gm2600", "Elo2400", "DCbook_large", "final-book", "komodo", "KomodoVariety", "Performance", "codekiddy"]
+# Used when searching without a fixed depth (the time budget decides when to stop)
+MAX_DEPTH = 64
 
-# Used for the endgame tablebase (change filepath for custom tablebase)
-try:
-    TABLEBASE = gaviota.open_tablebase("endgames/gaviota_3/gtb")
-except:
-    TABLEBASE = None
+# Used for time management when playing on a clock
+MOVES_TO_GO = 30
 
+# Number of processes used by get_best_action and how they split the work when there is more than one (see smp.py):
+# "smp" searches the whole tree in every process (Lazy SMP), "split" searches the root moves in a process pool and
+# gives the same result as one process with search.LMR off at a fixed depth
+THREADS = 1
+MODE = "smp"
+
+# Half width (in pawns) of the root window around the previous iteration's score (None searches the full window)
+ASPIRATION_WINDOW = 0.5
+
+# Used for the opening book (change filepath for custom opening book, "custom" is the one written by builder.py)
+BOOKS = ["custom", "gm2600", "Elo2400", "DCbook_large", "final-book", "komodo", "KomodoVariety", "Performance",
+         "codekiddy"]
+
+# Books that don't exist under openings/ are skipped, the rest stay memory mapped for the life of the process
+OPENING_BOOK = OpeningBook(BOOKS)
+
+# Seconds between checks while waiting for a ponder search to stop
+PONDER_POLL_INTERVAL = 0.01
+
+
+# Finds the best move in a given position at specified depth (or within movetime seconds). With a Ponder, the
+# search started on the opponent's time is used if the opponent played the expected move, and a new one is started
+# on the expected reply to the move made.
+def move(position, depth, book, movetime=None, ponder=None):
+    pondered = None
+
+    if ponder is not None:
+        pondered = ponder.finish(position, depth, movetime)
 
-# Finds the best move in a given position at specified depth
-def move(position, depth, book):
     if position.is_terminal():
         return None
 
     action = None
 
-    if book:
+    if pondered is not None:
+        action = pondered.get_move()
+        print("Ponder hit, depth " + str(INFO.get_depth()) + ", " + str(INFO.get_nodes()) + " nodes")
+    elif book:
         action = book_action(position)
 
     if action == chess.Move.null() or action is None:
         action = mate_n(position)
 
         if action is None:
-            action = get_best_action(position, depth).get_move()
+            action = get_best_action(position, depth, movetime=movetime).get_move()
+            print("Depth " + str(INFO.get_depth()) + ", " + str(INFO.get_nodes()) + " nodes")
         else:
+            print("M" + str(action.get_score()))
             action = action.get_move()
-    elif book:
+    elif book and pondered is None:
         print("Book")
 
-    position.get_state().push(action)
+    position.push(action)
+
+    if ponder is not None:
+        ponder.start(position, depth)
 
     return action
 
 
 # If there is a book move, return it
 def book_action(position):
-    action = chess.Move.null()
-    i = 0
-
-    while action == chess.Move.null() and i < len(BOOKS):
-        book = chess.polyglot.MemoryMappedReader("openings/" + BOOKS[i] + ".bin")
-
-        try:
-            action = book.weighted_choice(position.get_state()).move
-        except Exception:
-            action = chess.Move.null()
-
-        book.close()
-        i += 1
-
-    return action
+    return OPENING_BOOK.weighted_choice(position)
 
 
-# If the move is present in the endgame tablebase, return it.
+# If the move is present in the endgame tablebase, return it. Distance to mate is only probed here at the root,
+# the search itself uses the cached win/draw/loss probes.
 def mate_n(position):
-    try:
-        TABLEBASE.probe_dtm(position.get_state())
-    except Exception:
+    if not TABLEBASE.can_probe(position) or TABLEBASE.probe_dtm(position) is None:
         return None
 
-    wdl = TABLEBASE.probe_wdl(position.get_state())
+    wdl = TABLEBASE.probe_wdl(position)
 
     best = None
     best_score = math.inf if wdl > 0 else -math.inf
 
     for action in position.get_actions():
         is_mate = False
-        position.get_state().push(action)
-        dtm = TABLEBASE.probe_dtm(position.get_state())
+        position.push(action)
+        dtm = TABLEBASE.probe_dtm(position)
+
+        if dtm is None:
+            position.pop()
+            continue
 
         if dtm == 0 and position.get_winner() != 0:
             is_mate = True
 
-        position.get_state().pop()
+        position.pop()
 
         if abs(dtm) < best_score and wdl > 0 or abs(dtm) > best_score and wdl < 0 or dtm == 0 and wdl == 0:
 
             if dtm != 0 or is_mate or dtm == 0 and wdl == 0:
-                position.get_state().push(action)
+                position.push(action)
 
-                if TABLEBASE.probe_wdl(position.get_state()) == -wdl:
+                if TABLEBASE.probe_wdl(position) == -wdl:
                     best_score = abs(dtm)
                     best = action
 
-                position.get_state().pop()
-
-    print("M" + str(best_score))
+                position.pop()
 
     return data.Entry(best, best_score)
 
 
-# Returns the best move given the position sing a negamax search with a handcrafted heuristic
-def get_best_action(position, depth):
-    best_move = chess.Move.null()
-    best_score = -math.inf
-    alpha = -math.inf
-    beta = math.inf
-    actions = position.get_actions()
+# Returns the number of seconds to spend on a move, either a fixed move time or a share of the clock plus increment
+def get_time_budget(movetime=None, clock=None, increment=0, moves_to_go=MOVES_TO_GO):
+    if movetime is not None:
+        return movetime
+
+    if clock is not None:
+        return max(min(clock / moves_to_go + increment * 0.8, clock / 2), 0)
+
+    return None
+
+
+# Returns the best move given the position, searching with one process or with several processes in the given mode.
+# report(depth, entry) is called after every completed iteration. A data.SearchStats passed as stats is filled with
+# the statistics of a single process search.
+def get_best_action(position, depth=MAX_DEPTH, movetime=None, clock=None, increment=0, threads=None, mode=None,
+                    report=None, stats=None):
+    budget = get_time_budget(movetime, clock, increment)
+    threads = THREADS if threads is None else threads
+    mode = MODE if mode is None else mode
+
+    if threads > 1 and mode == "split":
+        return smp.get_split_pool(threads).search(position, depth, budget, report)
+    if threads > 1:
+        return smp.get_pool(threads).search(position, depth, budget, report)
+
+    if stats is None:
+        return iterative_deepening(position, depth, budget, report=report)
+
+    search.set_stats(stats)
+
+    try:
+        return iterative_deepening(position, depth, budget, report=report)
+    finally:
+        search.set_stats(None)
+
+
+# Returns the transposition table filled by get_best_action with these settings: the shared table of the Lazy SMP
+# workers, or search.TT (root splitting workers keep their tables to themselves, so it has no entries then)
+def get_table(threads=None, mode=None):
+    threads = THREADS if threads is None else threads
+    mode = MODE if mode is None else mode
+
+    if threads > 1 and mode != "split":
+        return smp.get_pool(threads).get_table()
+
+    return TT
+
+
+# Returns the principal variation starting with the given move, following the hash moves stored in the
+# transposition table (the one get_table returns by default) while they are legal and don't repeat a position
+def get_pv(position, action, max_length=MAX_DEPTH, table=None):
+    table = get_table() if table is None else table
+    pv = []
+    seen = set()
+
+    while action and len(pv) < max_length and position.get_state().is_legal(action):
+        position.push(action)
+        pv.append(action)
+
+        if position.get_zobrist_hash() in seen:
+            break
+
+        seen.add(position.get_zobrist_hash())
+        transposition = table.get(position.get_zobrist_hash())
+        action = transposition.get_entry().get_move() if transposition is not None else None
+
+    for i in range(len(pv)):
+        position.pop()
+
+    return pv
+
+
+# Returns the move expected in a position, the hash move left by the last search if it is legal, or None
+def get_expected_action(position, table=None):
+    table = get_table() if table is None else table
+    transposition = table.get(position.get_zobrist_hash())
+
+    if transposition is None:
+        return None
+
+    action = transposition.get_entry().get_move()
+
+    return action if action and position.get_state().is_legal(action) else None
+
+
+# Represents a search on the opponent's time. After the engine moves, the position after the expected reply is
+# searched in a background thread. If the opponent plays that reply the search carries on with its transposition
+# table and killers warm and gets what is left of the move time counted from when pondering started, otherwise it
+# is stopped within a few thousand nodes.
+class Ponder:
 
-    for action in actions:
-        position.get_state().push(action)
-        score = -negamax(position, -beta, -alpha, depth - 1)
+    def __init__(self, threads=None, mode=None):
+        self.threads = threads
+        self.mode = mode
+        self.thread = None
+        self.position = None
+        self.zobrist_hash = None
+        self.action = None
+        self.depth = None
+        self.start_time = None
+        self.result = None
 
-        if score > best_score:
-            best_score = score
-            best_move = action
+    def is_pondering(self):
+        return self.thread is not None
+
+    # The reply being pondered on
+    def get_action(self):
+        return self.action
+
+    # Starts pondering on the expected reply in a position (the one after the engine's move) and returns the reply,
+    # or None if no reply is expected. With a movetime the ponder search also stops on its own after that many
+    # seconds.
+    def start(self, position, depth=MAX_DEPTH, movetime=None):
+        self.stop()
+
+        action = get_expected_action(position, get_table(self.threads, self.mode))
+
+        if action is None:
+            return None
+
+        self.position = position.copy()
+        self.position.push(action)
+
+        if not self.position.get_actions():
+            self.position = None
+            return None
+
+        # Kept apart from the position, which the ponder search moves through
+        self.zobrist_hash = self.position.get_zobrist_hash()
+        self.action = action
+        self.depth = depth
+        self.start_time = time.perf_counter()
+        self.result = None
+        self.thread = threading.Thread(target=self.search, args=(depth, movetime), daemon=True)
+        self.thread.start()
+
+        return action
+
+    def search(self, depth, movetime):
+        self.result = get_best_action(self.position, depth, movetime=movetime, threads=self.threads, mode=self.mode)
+
+    # Called with the position the opponent left. Returns the best move of the ponder search if it was on this
+    # position and depth (waiting until movetime seconds after pondering started, or until the depth is done),
+    # or stops it and returns None.
+    def finish(self, position, depth=MAX_DEPTH, movetime=None):
+        if self.thread is None:
+            return None
+
+        if position.get_zobrist_hash() != self.zobrist_hash or depth != self.depth:
+            self.stop()
+            return None
+
+        deadline = math.inf if movetime is None else self.start_time + movetime
+
+        # Set again while waiting as the ponder search resets the deadline when it starts
+        while self.thread.is_alive():
+            INFO.set_deadline(min(INFO.get_deadline(), deadline))
+            self.thread.join(PONDER_POLL_INTERVAL)
+
+        self.thread = None
+
+        # A ponder search stopped before its first iteration has no move worth playing
+        return self.result if INFO.get_depth() else None
+
+    def stop(self):
+        while self.thread is not None and self.thread.is_alive():
+            INFO.stop()
+            self.thread.join(PONDER_POLL_INTERVAL)
+
+        self.thread = None
+        self.position = None
+        self.action = None
+
+
+# Searches with iterative deepening. Each iteration searches one ply deeper starting with the best move of the
+# previous one, until the depth is reached or the time budget runs out. Lazy SMP helpers start at a different
+# depth and shuffle the root moves after the first with their seed so they search different parts of the tree.
+def iterative_deepening(position, depth, budget=None, start_depth=1, seed=None, report=None):
+    actions = ordering.order_actions(position, position.get_actions())
+    best = data.Entry(actions[0], -math.inf)
+    ply = len(position.get_state().move_stack)
+
+    if seed is not None:
+        tail = actions[1:]
+        random.Random(seed).shuffle(tail)
+        actions[1:] = tail
+
+    TT.new_search()
+    ordering.new_search()
+    INFO.start(math.inf if budget is None else time.perf_counter() + budget)
+
+    for d in range(min(start_depth, depth), depth + 1):
+        try:
+            best = aspiration_search(position, actions, d, best.get_score())
+        except SearchTimeout:
+            while len(position.get_state().move_stack) > ply:
+                position.pop()
+
+            break
+
+        INFO.set_depth(d)
+
+        if report is not None:
+            report(d, best)
+
+        actions.remove(best.get_move())
+        actions.insert(0, best.get_move())
+
+        if abs(best.get_score()) >= MATE_BOUND:
+            break
+
+        # The next iteration takes several times longer, so don't start it if it's unlikely to finish
+        if budget is not None and INFO.get_elapsed() > budget / 2:
+            break
+
+    return best
+
+
+# Searches the root in a narrow window around the previous iteration's score and
+# opens the window on the side that fails until the score falls inside it
+def aspiration_search(position, actions, depth, previous_score):
+    if ASPIRATION_WINDOW is None or abs(previous_score) >= MATE_BOUND:
+        return search_root(position, actions, depth)
+
+    alpha = previous_score - ASPIRATION_WINDOW
+    beta = previous_score + ASPIRATION_WINDOW
+
+    while True:
+        best = search_root(position, actions, depth, alpha, beta)
+
+        if best.get_score() <= alpha:
+            alpha = -math.inf
+        elif best.get_score() >= beta:
+            beta = math.inf
+        else:
+            return best
+
+
+# Searches every root move to a fixed depth and returns the best one
+def search_root(position, actions, depth, alpha=-math.inf, beta=math.inf):
+    best = data.Entry(actions[0], -math.inf)
+
+    for i, action in enumerate(actions):
+        position.push(action)
+
+        if i == 0 or not search.PVS:
+            score = -negamax(position, -beta, -alpha, depth - 1)
+        else:
+            score = -negamax(position, -alpha - SCOUT_WINDOW, -alpha, depth - 1)
+
+            if alpha < score < beta:
+                score = -negamax(position, -beta, -alpha, depth - 1)
+
+        position.pop()
+
+        if score > best.get_score():
+            best.set_move(action)
+            best.set_score(score)
 
         if score > alpha:
             alpha = score
 
-        position.get_state().pop()
-
-    if best_move == chess.Move.null():
-        best_move = actions[0]
+        if alpha >= beta:
+            break
 
-    return data.Entry(best_move, best_score)
+    return best
@@ -3,20 +3,215 @@
 # Returns a score describing how good a player's position is in that player's perspective
 # --------------------------------------------------------------
 
-def evaluate(position):
-    position_data = {
-        "material": {
-            "weight": 1,
-            "score": (position.get_material_difference() + position.get_relative_material())
-        },
+import math
+import time
+import zlib
+
+import chess
+import numpy as np
+
+from red_chess.position import Position
+
+
+# Each side's king shield score is minus the number of missing shield pawns
+def get_king_shield_difference(position):
+    white_score, black_score = position.get_king_shields()
+
+    return white_score - black_score
+
+
+# Evaluation terms in the order they are computed (cheapest first). Each score is in centipawns from white's
+# perspective before weighting. The margin is the most the weighted term is expected to move the evaluation:
+# once the score is further outside the alpha/beta window than the margins of the remaining terms, they are skipped.
+TERMS = {
+    "material": {
+        "enabled": True,
+        "weight": 1,
+        "margin": 0,
+        "score": lambda position: position.get_material_difference() + position.get_relative_material()
+    },
+    "king_shields": {
+        "enabled": False,
+        "weight": 10,
+        "margin": 60,
+        "score": get_king_shield_difference
+    },
+    "center_control": {
+        "enabled": False,
+        "weight": 10,
+        "margin": 40,
+        "score": lambda position: position.get_center_control_difference()
+    },
+    "mobility": {
+        "enabled": False,
+        "weight": 5,
+        "margin": 150,
+        "score": lambda position: position.get_mobility_difference()
+    },
+    "space": {
+        "enabled": False,
+        "weight": 2,
+        "margin": 100,
+        "score": lambda position: position.get_space_difference()
+    },
+    "king_safety": {
+        "enabled": False,
+        "weight": 0.01,
+        "margin": 200,
+        "score": lambda position: position.get_king_safety() if position.get_player() else -position.get_king_safety()
     }
+}
+
+# Set to True to record the number of calls and the time spent in each term
+PROFILE = False
+TIMINGS = {}
+
+# Enabled terms as (name, weight, margin of the terms after it, score function), rebuilt by configure
+PIPELINE = []
+
+# Bump when a term's score changes, so transposition tables saved with the old scores are rejected
+EVALUATION_VERSION = 1
+
+
+# Enables, disables or reweights an evaluation term
+def configure(name, enabled=None, weight=None, margin=None):
+    term = TERMS[name]
+
+    if enabled is not None:
+        term["enabled"] = enabled
+    if weight is not None:
+        term["weight"] = weight
+    if margin is not None:
+        term["margin"] = margin
+
+    build_pipeline()
+
+
+# Identifies the evaluation: its version and the enabled terms with their weights and margins
+def get_evaluation_version():
+    terms = [(name, term["weight"], term["margin"]) for name, term in TERMS.items() if term["enabled"]]
+
+    return zlib.crc32(repr((EVALUATION_VERSION, terms)).encode())
+
+
+def build_pipeline():
+    enabled = [(name, term) for name, term in TERMS.items() if term["enabled"]]
+    PIPELINE.clear()
+
+    for i, (name, term) in enumerate(enabled):
+        remaining = sum(later["margin"] for _, later in enabled[i + 1:])
+        PIPELINE.append((name, term["weight"], remaining, term["score"]))
+
+
+def evaluate(position, alpha=-math.inf, beta=math.inf):
+    if PROFILE:
+        return evaluate_profiled(position, alpha, beta)
+
+    sign = 1 if position.get_player() == chess.WHITE else -1
+    evaluation = 0
+
+    for name, weight, remaining, score in PIPELINE:
+        evaluation += weight * score(position)
+
+        if remaining:
+            bound = sign * evaluation / 100
 
+            if bound - remaining / 100 >= beta or bound + remaining / 100 <= alpha:
+                break
+
+    return sign * evaluation / 100
+
+
+# Same as evaluate, but adds the number of calls and seconds spent in each term to TIMINGS
+def evaluate_profiled(position, alpha=-math.inf, beta=math.inf):
+    sign = 1 if position.get_player() == chess.WHITE else -1
     evaluation = 0
 
-    for value in position_data.values():
-        evaluation += value["weight"] * value["score"]
+    for name, weight, remaining, score in PIPELINE:
+        start = time.perf_counter()
+        evaluation += weight * score(position)
+        timing = TIMINGS.setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += time.perf_counter() - start
+
+        if remaining:
+            bound = sign * evaluation / 100
+
+            if bound - remaining / 100 >= beta or bound + remaining / 100 <= alpha:
+                break
+
+    return sign * evaluation / 100
+
+
+# Returns the calls, total seconds and microseconds per call of every profiled term
+def get_timings():
+    return {
+        name: {
+            "calls": calls,
+            "seconds": seconds,
+            "us_per_call": seconds / calls * 1000000 if calls else 0
+        } for name, (calls, seconds) in TIMINGS.items()
+    }
+
+
+def reset_timings():
+    TIMINGS.clear()
+
+
+# Scores many boards (chess.Board or Position) at once and returns an array equal to calling evaluate on each.
+# The material term is computed with NumPy from (N, 12, 64) occupancy tensors built straight from the bitboards;
+# other enabled terms are added one position at a time.
+def evaluate_batch(boards, chunk_size=65536):
+    boards = [board.get_state() if isinstance(board, Position) else board for board in boards]
+    scores = np.zeros(len(boards))
+    weights = {name: weight for name, weight, remaining, score in PIPELINE}
+
+    if "material" in weights:
+        for start in range(0, len(boards), chunk_size):
+            chunk = boards[start:start + chunk_size]
+            scores[start:start + len(chunk)] = weights["material"] * evaluate_material_batch(chunk)
+
+    extra = [(weight, score) for name, weight, remaining, score in PIPELINE if name != "material"]
+
+    if extra:
+        for i, board in enumerate(boards):
+            position = Position(board)
+            sign = 1 if board.turn == chess.WHITE else -1
+            scores[i] += sign * sum(weight * score(position) for weight, score in extra) / 100
+
+    return scores
+
+
+# Returns the (N, 12, 64) piece occupancy of the boards, with planes ordered like the zobrist table
+def get_occupancy(boards):
+    bitboards = np.array([
+        (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+         board.occupied_co[chess.BLACK], board.occupied_co[chess.WHITE])
+        for board in boards
+    ], dtype="<u8").reshape(len(boards), 8)
+    planes = bitboards[:, :6, None] & bitboards[:, None, 6:]
+
+    return np.unpackbits(planes.view(np.uint8).reshape(len(boards), 12, 8), axis=2, bitorder="little")
+
+
+def evaluate_material_batch(boards):
+    if not boards:
+        return np.empty(0)
+
+    occupancy = get_occupancy(boards).reshape(len(boards), 768)
+    terms = np.rint(occupancy.astype(np.float64) @ PIECE_TABLES).astype(np.int64)
+    material, phase_material, middlegame, endgame = terms.T
+
+    total_phase = Position.total_phase
+    phase = np.clip(((total_phase - phase_material) * 256 + total_phase // 2) // total_phase, 0, 256)
+    psq = (middlegame * (256 - phase) + endgame * phase) // 256
+    sign = np.where(np.fromiter((board.turn for board in boards), bool, len(boards)), 1, -1)
+
+    return sign * (material + psq) / 100
+
 
-    if not position.get_player():
-        evaluation *= -1
+# Material, phase and piece-square tables of Position stacked into a (768, 4) matrix for evaluate_batch
+PIECE_TABLES = np.array([Position.material_table, Position.phase_table,
+                         Position.middlegame_table, Position.endgame_table], dtype=np.float64).T
 
-    return evaluation / 100
+build_pipeline()
@@ -0,0 +1,162 @@
+# Chess v3.2.0 Ordering
+# --------------------------------------------------------------
+# Orders moves so the search tries the ones most likely to cause a cutoff first
+# --------------------------------------------------------------
+
+import chess
+
+MAX_PLY = 128
+
+# Each kind of move gets its own band: hash move, captures (MVV/LVA), killers, then quiet moves by history
+HASH_MOVE = 1000000
+CAPTURE = 100000
+KILLER = 90000
+HISTORY_LIMIT = 80000
+
+# Two killer moves (quiet moves that caused a cutoff) per ply
+KILLERS = [[None, None] for i in range(MAX_PLY)]
+
+# Cutoff counts weighted by depth, indexed by color * 4096 + from square * 64 + to square
+HISTORY = [0] * 8192
+
+
+# Forgets the killers of the previous search and halves the history scores
+def new_search():
+    for killers in KILLERS:
+        killers[0] = None
+        killers[1] = None
+
+    age_history()
+
+
+def clear():
+    for killers in KILLERS:
+        killers[0] = None
+        killers[1] = None
+
+    for i in range(len(HISTORY)):
+        HISTORY[i] = 0
+
+
+def age_history():
+    for i in range(len(HISTORY)):
+        HISTORY[i] //= 2
+
+
+# Returns the moves sorted from most to least promising without playing any of them
+def order_actions(position, actions, hash_move=None, ply=0):
+    state = position.get_state()
+    piece_type_at = state.piece_type_at
+    killers = KILLERS[min(ply, MAX_PLY - 1)]
+    offset = 4096 if state.turn else 0
+
+    def score(action):
+        if action == hash_move:
+            return HASH_MOVE
+
+        victim = piece_type_at(action.to_square)
+
+        if victim:
+            return CAPTURE + victim * 8 - piece_type_at(action.from_square)
+        if action.promotion:
+            return CAPTURE + action.promotion * 8 - chess.PAWN
+        if state.is_en_passant(action):
+            return CAPTURE + chess.PAWN * 8 - chess.PAWN
+        if action == killers[0]:
+            return KILLER
+        if action == killers[1]:
+            return KILLER - 1
+
+        return HISTORY[offset + action.from_square * 64 + action.to_square]
+
+    return sorted(actions, key=score, reverse=True)
+
+
+# Returns the MVV/LVA score of a capture or promotion (higher first) and whether it may lose material
+def get_capture_score(state, action):
+    attacker = state.piece_type_at(action.from_square)
+    victim = state.piece_type_at(action.to_square)
+
+    if not victim and attacker == chess.PAWN and action.to_square == state.ep_square:
+        victim = chess.PAWN
+
+    return (victim or 0) * 8 + (action.promotion or 0) * 8 - attacker
+
+
+# Yields the legal moves of a position in stages: the hash move, captures and promotions by MVV/LVA, killers, quiet
+# moves by history, then captures that lose material by static exchange evaluation. A stage is only generated once
+# the previous one is used up and legality is only checked for the move about to be searched, so a cutoff on the
+# hash move or a capture skips generating and sorting the quiet moves. In check all evasions are ordered at once.
+def pick_actions(position, hash_move=None, ply=0):
+    state = position.get_state()
+
+    if state.is_check():
+        yield from order_actions(position, list(state.generate_legal_moves()), hash_move, ply)
+        return
+
+    if hash_move and state.is_legal(hash_move):
+        yield hash_move
+    else:
+        hash_move = None
+
+    # Not in check, a pseudo-legal move is legal if it doesn't expose the king. python-chess does the same test in
+    # its legal move generator, computing the pinned pieces once per position instead of once per move.
+    king = state.king(state.turn)
+    blockers = state._slider_blockers(king)
+    is_safe = state._is_safe
+    values = position.pieces
+    captures = list(state.generate_pseudo_legal_captures())
+    captures += state.generate_pseudo_legal_moves(state.pawns, chess.BB_BACKRANKS & ~state.occupied)
+    captures.sort(key=lambda action: get_capture_score(state, action), reverse=True)
+    bad_captures = []
+
+    for action in captures:
+        if action == hash_move:
+            continue
+
+        attacker = state.piece_type_at(action.from_square)
+        victim = state.piece_type_at(action.to_square) or chess.PAWN
+
+        if not action.promotion and values[attacker] > values[victim] and position.get_see(action) < 0:
+            bad_captures.append(action)
+        elif is_safe(king, blockers, action):
+            yield action
+
+    killers = []
+
+    for killer in KILLERS[min(ply, MAX_PLY - 1)]:
+        if killer and killer != hash_move and killer not in killers and not killer.promotion and \
+                not state.is_capture(killer) and state.is_legal(killer):
+            killers.append(killer)
+            yield killer
+
+    offset = 4096 if state.turn else 0
+    quiets = [
+        action for action in state.generate_pseudo_legal_moves(chess.BB_ALL, ~state.occupied_co[not state.turn])
+        if not action.promotion and action != hash_move and action not in killers and
+        not (action.to_square == state.ep_square and state.is_en_passant(action))
+    ]
+    quiets.sort(key=lambda action: HISTORY[offset + action.from_square * 64 + action.to_square], reverse=True)
+
+    for action in quiets:
+        if is_safe(king, blockers, action):
+            yield action
+
+    for action in bad_captures:
+        if is_safe(king, blockers, action):
+            yield action
+
+
+# Records a quiet move that caused a beta cutoff
+def store_cutoff(position, action, ply, depth):
+    killers = KILLERS[min(ply, MAX_PLY - 1)]
+
+    if action != killers[0]:
+        killers[1] = killers[0]
+        killers[0] = action
+
+    i = (4096 if position.get_player() else 0) + action.from_square * 64 + action.to_square
+    HISTORY[i] += depth * depth
+
+    if HISTORY[i] > HISTORY_LIMIT:
+        age_history()
@@ -7,13 +7,44 @@ from contextlib import suppress
 
 # Library used for move generation
 import chess
+from chess import polyglot
 
 import numpy as np
 import random
+import zlib
 
 
-def piece_index(piece):
-    return list(Position.piece_values.keys()).index(piece) if piece in Position.piece_values else -1
+# Offsets of the castling, en passant and side to move keys in the zobrist table
+ZOBRIST_CASTLING = 768
+ZOBRIST_EN_PASSANT = 772
+ZOBRIST_TURN = 780
+
+
+# Returns a zobrist table in the polyglot key layout. Without a seed this is the polyglot table itself,
+# so hashes match chess.polyglot.zobrist_hash and the opening books. The same seed always gives the same table.
+def get_zobrist_table(seed=None):
+    if seed is None:
+        return list(polyglot.POLYGLOT_RANDOM_ARRAY[:781])
+
+    generator = random.Random(seed)
+
+    return [generator.getrandbits(64) for i in range(781)]
+
+
+# Replaces the zobrist table used by every position (call before creating positions, existing hashes become stale)
+def set_zobrist_seed(seed=None):
+    Position.ztable = get_zobrist_table(seed)
+
+
+# Identifies the zobrist table in use, so hashes made with another table (e.g. in saved transposition tables)
+# are recognised
+def get_zobrist_scheme():
+    return zlib.crc32(np.array(Position.ztable, np.uint64).tobytes())
+
+
+# Returns the index of a piece on a square in the zobrist table
+def zobrist_index(piece_type, color, square):
+    return 64 * ((piece_type - 1) * 2 + color) + square
 
 
 # Returns rectangular coordinates for a square in range [0, 64]
@@ -25,9 +56,6 @@ def get_square_coordinates(square):
 
 class Position:
     squares = np.flip(np.array(chess.SQUARES).reshape(8, 8), 0)
-    phases = {
-        "endgame": 110
-    }
     pieces = {
         chess.PAWN: 100,
         chess.KNIGHT: 320,
@@ -188,10 +216,24 @@ class Position:
     attack_table = [0, 0, 50, 75, 88, 94, 97, 99]
 
     center_squares = [chess.D4, chess.E4, chess.D5, chess.E5]
-    ztable = [[[random.randint(1, 2 ** 64 - 1) for i in range(12)] for j in range(8)] for k in range(8)]
+    ztable = get_zobrist_table()
+
+    def __init__(self, state=None):
+        if state is None:
+            state = chess.Board()
 
-    def __init__(self, state=chess.Board()):
         self.state = state
+        self.zobrist_hash = self.compute_zobrist_hash()
+        self.hash_stack = []
+
+        # Running evaluation terms, all from white's point of view except the phase material (see push)
+        self.material = 0
+        self.phase_material = 0
+        self.middlegame_psq = 0
+        self.endgame_psq = 0
+        self.accumulator_stack = []
+
+        self.compute_accumulators()
 
     def __str__(self):
         return self.state.unicode()
@@ -200,9 +242,9 @@ class Position:
     def get_state(self):
         return self.state
 
+    # Unordered, the search orders moves itself (see ordering.py)
     def get_actions(self):
-        return sorted(list(self.state.legal_moves), key=self.sort_actions)
-        # return list(self.state.legal_moves)
+        return list(self.state.legal_moves)
 
     def get_player(self):
         return self.state.turn
@@ -218,6 +260,13 @@ class Position:
         return sorted(list(self.state.generate_legal_captures()), key=self.sort_captures)
         # return list(self.state.generate_legal_captures())
 
+    # Returns (static exchange score, capture) pairs for every legal capture, best exchange first
+    def get_captures_by_see(self):
+        captures = [(self.get_see(capture), capture) for capture in self.state.generate_legal_captures()]
+        captures.sort(key=lambda pair: (-pair[0], self.sort_captures(pair[1])))
+
+        return captures
+
     def get_checks_and_captures(self):
         checks_and_captures = self.get_captures()
 
@@ -230,34 +279,197 @@ class Position:
     def get_king_location(self, side):
         return get_square_coordinates(self.state.king(side))
 
+    # Returns the game phase from 0 (all pieces on the board) to 256 (only kings and pawns)
     def get_phase(self):
-        total_phase = 0
-        subtract = 0
+        phase = Position.total_phase - self.phase_material
+        phase = (phase * 256 + Position.total_phase // 2) // Position.total_phase
 
-        for piece in Position.piece_phases:
-            total_phase += Position.piece_phases[piece][0] * Position.piece_phases[piece][1]
-            white_pieces = len(self.state.pieces(piece, chess.WHITE))
-            black_pieces = len(self.state.pieces(piece, chess.BLACK))
-            subtract += white_pieces + black_pieces
+        return min(max(phase, 0), 256)
+
+    def get_zobrist_hash(self):
+        return self.zobrist_hash
 
-        phase = total_phase - subtract
+    def is_terminal(self):
+        return self.state.is_game_over()
 
-        return (phase * 256 + (total_phase / 2)) / total_phase
+    # True if the position occurred before with the same side to move since the last capture, pawn move or null
+    # move (positions before a null move played by the search aren't reached by real moves). Only the hashes kept by
+    # push are compared, so this is much cheaper than chess.Board.is_repetition.
+    def is_repetition(self):
+        stack = self.hash_stack
+        moves = self.state.move_stack
+        offset = len(moves) - len(stack)
+        start = len(stack) - 2
+        stop = max(start - self.state.halfmove_clock, -1)
+
+        for i in range(start, stop, -2):
+            if not moves[i + offset] or not moves[i + offset + 1]:
+                return False
+            if stack[i] == self.zobrist_hash:
+                return True
+
+        return False
+
+    # Copies the board together with the hash and accumulator history, so searches of the copy see repetitions
+    def copy(self):
+        position = Position.__new__(Position)
+        position.state = self.state.copy()
+        position.zobrist_hash = self.zobrist_hash
+        position.hash_stack = self.hash_stack.copy()
+        position.material = self.material
+        position.phase_material = self.phase_material
+        position.middlegame_psq = self.middlegame_psq
+        position.endgame_psq = self.endgame_psq
+        position.accumulator_stack = self.accumulator_stack.copy()
+
+        return position
+
+    # Make/unmake methods
+    # Plays a move and updates the zobrist hash (pieces, castling rights, en passant file and side to move)
+    # and the evaluation accumulators with the pieces it removes and places
+    def push(self, action):
+        state = self.state
+        ztable = Position.ztable
+        h = self.zobrist_hash ^ self.get_castling_hash() ^ self.get_en_passant_hash() ^ ztable[ZOBRIST_TURN]
+
+        self.hash_stack.append(self.zobrist_hash)
+        self.accumulator_stack.append((self.material, self.phase_material, self.middlegame_psq, self.endgame_psq))
+
+        if action:
+            color = state.turn
+            from_square = action.from_square
+            to_square = action.to_square
+            piece_type = state.piece_type_at(from_square)
+            removed = [zobrist_index(piece_type, color, from_square)]
+
+            if state.is_castling(action):
+                rank = chess.square_rank(from_square)
+                kingside = state.is_kingside_castling(action)
+
+                if state.color_at(to_square) == color:
+                    rook_square = to_square
+                else:
+                    rook_square = chess.square(7 if kingside else 0, rank)
 
-    def get_zobrist_hash(self):
-        board = self.to_array()
+                to_square = chess.square(6 if kingside else 2, rank)
+                removed.append(zobrist_index(chess.ROOK, color, rook_square))
+                added = [zobrist_index(chess.ROOK, color, chess.square(5 if kingside else 3, rank))]
+            else:
+                added = []
+
+                if state.is_en_passant(action):
+                    removed.append(zobrist_index(chess.PAWN, not color, to_square - 8 if color else to_square + 8))
+                else:
+                    captured = state.piece_type_at(to_square)
+
+                    if captured:
+                        removed.append(zobrist_index(captured, not color, to_square))
+
+            added.append(zobrist_index(action.promotion or piece_type, color, to_square))
+
+            material = self.material
+            phase_material = self.phase_material
+            middlegame_psq = self.middlegame_psq
+            endgame_psq = self.endgame_psq
+
+            for i in removed:
+                h ^= ztable[i]
+                material -= Position.material_table[i]
+                phase_material -= Position.phase_table[i]
+                middlegame_psq -= Position.middlegame_table[i]
+                endgame_psq -= Position.endgame_table[i]
+
+            for i in added:
+                h ^= ztable[i]
+                material += Position.material_table[i]
+                phase_material += Position.phase_table[i]
+                middlegame_psq += Position.middlegame_table[i]
+                endgame_psq += Position.endgame_table[i]
+
+            self.material = material
+            self.phase_material = phase_material
+            self.middlegame_psq = middlegame_psq
+            self.endgame_psq = endgame_psq
+
+        state.push(action)
+        self.zobrist_hash = h ^ self.get_castling_hash() ^ self.get_en_passant_hash()
+
+    # Takes back the last move and restores the zobrist hash and accumulators from before it was played
+    def pop(self):
+        action = self.state.pop()
+
+        if self.hash_stack:
+            self.zobrist_hash = self.hash_stack.pop()
+            self.material, self.phase_material, self.middlegame_psq, self.endgame_psq = self.accumulator_stack.pop()
+        else:
+            self.zobrist_hash = self.compute_zobrist_hash()
+            self.compute_accumulators()
+
+        return action
+
+    # Hashing methods
+    # Computes the zobrist hash from scratch
+    def compute_zobrist_hash(self):
+        state = self.state
+        h = self.get_castling_hash() ^ self.get_en_passant_hash()
+
+        for square, piece in state.piece_map().items():
+            h ^= Position.ztable[zobrist_index(piece.piece_type, piece.color, square)]
+
+        if state.turn == chess.WHITE:
+            h ^= Position.ztable[ZOBRIST_TURN]
+
+        return h
+
+    def get_castling_hash(self):
+        rights = self.state.castling_rights
         h = 0
 
-        for i in range(8):
-            for j in range(8):
-                if board[i][j] != '.':
-                    piece = piece_index(board[i][j])
-                    h ^= Position.ztable[i][j][piece]
+        if rights & chess.BB_H1:
+            h ^= Position.ztable[ZOBRIST_CASTLING]
+        if rights & chess.BB_A1:
+            h ^= Position.ztable[ZOBRIST_CASTLING + 1]
+        if rights & chess.BB_H8:
+            h ^= Position.ztable[ZOBRIST_CASTLING + 2]
+        if rights & chess.BB_A8:
+            h ^= Position.ztable[ZOBRIST_CASTLING + 3]
 
         return h
 
-    def is_terminal(self):
-        return self.state.is_game_over()
+    # Evaluation accumulator methods
+    # Computes the material, phase material and piece-square sums from scratch
+    def compute_accumulators(self):
+        self.material = 0
+        self.phase_material = 0
+        self.middlegame_psq = 0
+        self.endgame_psq = 0
+
+        for square, piece in self.state.piece_map().items():
+            i = zobrist_index(piece.piece_type, piece.color, square)
+            self.material += Position.material_table[i]
+            self.phase_material += Position.phase_table[i]
+            self.middlegame_psq += Position.middlegame_table[i]
+            self.endgame_psq += Position.endgame_table[i]
+
+    # Only hashes the en passant file when a pawn is ready to capture on it
+    def get_en_passant_hash(self):
+        state = self.state
+        ep_square = state.ep_square
+
+        if ep_square is None:
+            return 0
+
+        if state.turn == chess.WHITE:
+            mask = chess.shift_down(chess.BB_SQUARES[ep_square])
+        else:
+            mask = chess.shift_up(chess.BB_SQUARES[ep_square])
+
+        mask = chess.shift_left(mask) | chess.shift_right(mask)
+
+        if mask & state.pawns & state.occupied_co[state.turn]:
+            return Position.ztable[ZOBRIST_EN_PASSANT + chess.square_file(ep_square)]
+
+        return 0
 
     # Utility methods
     def to_array(self):
@@ -296,20 +508,23 @@ class Position:
     def get_black_material(self):
         return self.get_material()[1]
 
+    # Piece-square score blended between the middlegame and endgame tables by the game phase
     def get_relative_material(self):
-        points = 0
+        phase = self.get_phase()
 
-        for piece in Position.pieces:
-            points += self.get_psq_value(piece)
+        return (self.middlegame_psq * (256 - phase) + self.endgame_psq * phase) // 256
 
-        # print(self, points)
+    def get_material_difference(self):
+        return self.material
 
-        return points
+    # Material of a side's knights, bishops, rooks and queens
+    def get_non_pawn_material(self, color):
+        material = 0
 
-    def get_material_difference(self):
-        material = self.get_material()
+        for piece in (chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN):
+            material += chess.popcount(self.state.pieces_mask(piece, color)) * Position.pieces[piece]
 
-        return material[0] - material[1]
+        return material
 
     # Center control
     def get_center_control(self):
@@ -361,19 +576,18 @@ class Position:
 
     # Piece mobility
     def get_white_mobility(self):
-        if not self.get_player():
-            self.state.push(chess.Move.null())
-
-        count = len(list(self.state.legal_moves))
-        self.state.pop()
-
-        return count
+        return self.get_mobility(chess.WHITE)
 
     def get_black_mobility(self):
-        if self.get_player():
-            self.state.push(chess.Move.null())
+        return self.get_mobility(chess.BLACK)
 
-        count = len(list(self.state.legal_moves))
+    # Counts the legal moves a side would have if it were its turn
+    def get_mobility(self, color):
+        if self.get_player() == color:
+            return self.state.legal_moves.count()
+
+        self.state.push(chess.Move.null())
+        count = self.state.legal_moves.count()
         self.state.pop()
 
         return count
@@ -440,78 +654,63 @@ class Position:
         return 28 if self.get_player() else -28
 
     # Helper methods
-    # Sorts moves using MVV/LVA move ordering
-    def sort_actions(self, action):
-        score = 0
-
-        if self.state.is_capture(action):
-            victim = str(self.state.piece_at(action.to_square))
-            attacker = str(self.state.piece_at(action.from_square))
-
-            if victim != "None" and attacker != "None":
-                score -= Position.piece_values[victim] - Position.piece_values[attacker]
-
-        self.state.push(action)
-
-        if self.is_terminal():
-            score -= 999
-
-        self.state.pop()
-
-        return score
-
     # Sorts captures using MVV/LVA move ordering
     def sort_captures(self, capture):
-        victim = str(self.state.piece_at(capture.to_square))
-        attacker = str(self.state.piece_at(capture.from_square))
-
-        if victim == "None" or attacker == "None":
-            return 999
+        victim = self.state.piece_type_at(capture.to_square) or chess.PAWN
+        attacker = self.state.piece_type_at(capture.from_square)
+
+        return attacker - victim * 8
+
+    # Static exchange evaluation: the material (in centipawns) the side to move wins or loses on the target square
+    # if both sides keep recapturing with their least valuable attacker and may stop whenever continuing loses.
+    # Attackers are recomputed from the bitboards after each capture so x-rays behind the moved pieces join in.
+    def get_see(self, action):
+        state = self.state
+        target = action.to_square
+        occupied = state.occupied & ~chess.BB_SQUARES[action.from_square]
+
+        if state.is_en_passant(action):
+            victim = chess.PAWN
+            occupied &= ~chess.BB_SQUARES[target + (-8 if state.turn else 8)]
+        else:
+            victim = state.piece_type_at(target)
 
-        return -(Position.piece_values[victim] - Position.piece_values[attacker])
+        gains = [Position.pieces[victim] if victim else 0]
+        on_target = Position.pieces[state.piece_type_at(action.from_square)]
 
-    # Gets the relative value of a piece based on its position on the board
-    def get_psq_value(self, piece):
-        phase = self.get_phase()
-        if phase >= Position.phases["endgame"] and (piece == chess.KING or piece == chess.PAWN):
-            table = Position.endgame_piece_square_table[piece]
+        if action.promotion:
+            gains[0] += Position.pieces[action.promotion] - Position.pieces[chess.PAWN]
+            on_target = Position.pieces[action.promotion]
 
-            if piece == chess.KING:
-                pawntable = Position.endgame_piece_square_table[chess.PAWN]
-        else:
-            table = Position.piece_square_tables[piece]
+        color = not state.turn
+        piece_masks = (state.pawns, state.knights, state.bishops, state.rooks, state.queens, state.kings)
 
-        psq = sum([table[i] for i in self.state.pieces(piece, chess.WHITE)])
-        psq += sum([-table[chess.square_mirror(i)] for i in self.state.pieces(piece, chess.BLACK)])
+        while True:
+            attackers = state.attackers_mask(color, target, occupied) & occupied
 
-        if phase >= Position.phases["endgame"] and piece == chess.KING:
-            white_pawn_locations = self.state.pieces(chess.PAWN, chess.WHITE)
-            black_pawn_locations = self.state.pieces(chess.PAWN, chess.BLACK)
-            white_king_distance = 0
-            black_king_distance = 0
-            white_weights = 0
-            black_weights = 0
+            if not attackers:
+                break
 
-            if len(white_pawn_locations) > 0:
-                for i in white_pawn_locations:
-                    white_king_distance += chess.square_distance(self.state.king(chess.WHITE), i) * \
-                                           pawntable[i]
+            for piece_type, mask in enumerate(piece_masks, chess.PAWN):
+                if attackers & mask:
+                    break
 
-                    white_weights += pawntable[i]
+            # The king may only recapture if the square is no longer defended
+            if piece_type == chess.KING and state.attackers_mask(not color, target, occupied) & occupied:
+                break
 
-            if len(black_pawn_locations) > 0:
-                for i in black_pawn_locations:
-                    black_king_distance += chess.square_distance(self.state.king(chess.BLACK), i) * \
-                                           -pawntable[chess.square_mirror(i)]
+            gains.append(on_target)
+            on_target = Position.pieces[piece_type]
+            occupied &= ~chess.BB_SQUARES[chess.lsb(attackers & mask)]
+            color = not color
 
-                    black_weights -= pawntable[chess.square_mirror(i)]
-
-            white_pawn_tropism = white_king_distance / white_weights if white_weights != 0 else 0
-            black_pawn_tropism = black_king_distance / black_weights if black_weights != 0 else 0
+        # Every recapture after the first capture is optional
+        score = 0
 
-            psq += white_pawn_tropism + black_pawn_tropism
+        for gain in reversed(gains[1:]):
+            score = max(0, gain - score)
 
-        return psq
+        return gains[0] - score
 
     # Gets the number of pawns protecting the kings (out of 3)
     def get_king_shields(self):
@@ -540,8 +739,9 @@ class Position:
         same = self.state.king(color)
         opposite = self.state.king(not color)
         square_set = []
+        pushed = self.get_player() != color
 
-        if self.get_player() != color:
+        if pushed:
             self.state.push(chess.Move.null())
 
         for action in self.state.pseudo_legal_moves:
@@ -560,6 +760,40 @@ class Position:
                     with suppress(IndexError):
                         square_set.append(action.to_square + 16)
 
-        self.state.pop()
+        if pushed:
+            self.state.pop()
+
+        return list(chess.SquareSet([square for square in square_set if 0 <= square < 64]))
+
+
+# Returns the material, phase weight and middlegame/endgame piece-square values of every piece on every square,
+# indexed like the zobrist table. Material and piece-square values are negative for black.
+def get_piece_tables():
+    material_table = [0] * 768
+    phase_table = [0] * 768
+    middlegame_table = [0] * 768
+    endgame_table = [0] * 768
+
+    for piece_type in Position.pieces:
+        middlegame = Position.piece_square_tables[piece_type]
+        endgame = Position.endgame_piece_square_table.get(piece_type, middlegame)
+        phase = Position.piece_phases[piece_type][0] if piece_type in Position.piece_phases else 0
+
+        for square in chess.SQUARES:
+            white = zobrist_index(piece_type, chess.WHITE, square)
+            black = zobrist_index(piece_type, chess.BLACK, square)
+            mirror = chess.square_mirror(square)
+
+            material_table[white] = Position.pieces[piece_type]
+            material_table[black] = -Position.pieces[piece_type]
+            phase_table[white] = phase_table[black] = phase
+            middlegame_table[white] = middlegame[square]
+            middlegame_table[black] = -middlegame[mirror]
+            endgame_table[white] = endgame[square]
+            endgame_table[black] = -endgame[mirror]
+
+    return material_table, phase_table, middlegame_table, endgame_table
+
 
-        return list(chess.SquareSet(square_set))
+Position.material_table, Position.phase_table, Position.middlegame_table, Position.endgame_table = get_piece_tables()
+Position.total_phase = sum(weight * count for weight, count in Position.piece_phases.values())
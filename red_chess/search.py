@@ -4,12 +4,66 @@
 # --------------------------------------------------------------
 
 import math
+import sys
+
 import chess
 
-from red_chess import data
-from red_chess.evaluation import evaluate
+from red_chess import data, ordering
+from red_chess.evaluation import evaluate, get_evaluation_version
+from red_chess.position import Position, get_zobrist_scheme
+from red_chess.tablebase import Tablebase
+
+# Being mated n plies from the root scores -(MATE_SCORE - n). Scores beyond MATE_BOUND are mates.
+MATE_SCORE = 10000
+MATE_BOUND = MATE_SCORE - ordering.MAX_PLY
+DRAW_SCORE = 0
+
+# Principal variation search: moves after the first are searched with a null window around alpha and only
+# re-searched with the full window if they beat it
+PVS = True
+SCOUT_WINDOW = 0.01
+
+# Windows are built in float pawns (e.g. -alpha - SCOUT_WINDOW), so a null window can come out slightly wider than
+# SCOUT_WINDOW. Anything narrower than this is still a null window.
+PV_WINDOW = SCOUT_WINDOW * 1.5
+
+# Null-move pruning: if passing still fails high in a search reduced by NULL_MOVE_REDUCTION plies, the node is cut.
+# Skipped in check, at PV nodes and (because of zugzwang) without non-pawn material or past NULL_MOVE_MAX_PHASE.
+NULL_MOVE = True
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_MAX_PHASE = 200
+
+# Late-move reductions: quiet moves from the LMR_MIN_MOVES-th on are searched LMR_REDUCTION plies shallower
+# (one more after LMR_LATE_MOVES) and re-searched at full depth if they beat alpha
+LMR = True
+LMR_MIN_DEPTH = 3
+LMR_MIN_MOVES = 3
+LMR_LATE_MOVES = 8
+LMR_REDUCTION = 1
+
+# Quiescence pruning: captures that lose material by static exchange evaluation are skipped, and so are captures
+# whose exchange gain plus DELTA_MARGIN centipawns can't lift the static evaluation to alpha (delta pruning, off
+# past DELTA_MAX_PHASE where a few pawns decide the game)
+SEE_PRUNING = True
+DELTA_PRUNING = True
+DELTA_MARGIN = 200
+DELTA_MAX_PHASE = 200
+
+# Score of a tablebase win: below any mate found by the search but above any evaluation
+TABLEBASE_WIN = MATE_SCORE / 2
 
 TT = data.TranspositionTable()
+INFO = data.SearchInfo()
+TABLEBASE = Tablebase()
+
+# Statistics of the running search (a data.SearchStats), None when they aren't collected
+STATS = None
+
+
+# Raised inside the search when the time limit is reached or the search is stopped
+class SearchTimeout(Exception):
+    pass
 
 
 # Recursively explores each state in the game tree until the max depth is reached
@@ -18,39 +72,117 @@ def negamax(position, alpha, beta, max_depth, depth=0, searching=True):
     if not searching:
         return evaluate(position)
 
+    INFO.nodes += 1
+
+    if not INFO.nodes & INFO.CHECK_MASK and INFO.is_stopped():
+        raise SearchTimeout()
+
+    state = position.get_state()
+    ply = depth + 1
+
+    # Repetitions and bare kings are draws (mate and stalemate show up as no legal moves), and so is the fifty-move
+    # rule unless the move that reached it mated
+    if position.is_repetition() or chess.popcount(state.occupied) <= 4 and state.is_insufficient_material():
+        return DRAW_SCORE
+    if state.halfmove_clock >= 100 and (not state.is_check() or any(state.generate_legal_moves())):
+        return DRAW_SCORE
+
     zhash = position.get_zobrist_hash()
     a = alpha
+    hash_move = None
+    stats = STATS
 
     transposition = TT.get(zhash)
 
-    if transposition.get_flag() != data.Transposition.NOT_PRESENT and transposition.get_depth() >= depth:
+    if stats is not None:
+        stats.nodes[ply] += 1
+        stats.tt_probes[ply] += 1
+        stats.tt_hits[ply] += transposition is not None
+
+    if transposition is not None:
+        hash_move = transposition.get_entry().get_move()
+
+    if transposition is not None and transposition.get_depth() >= max_depth - depth:
+        score = score_from_tt(transposition.get_entry().get_score(), ply)
+
         if transposition.get_flag() == data.Transposition.EXACT:
-            return transposition.get_entry().get_score()
+            return score
         elif transposition.get_flag() == data.Transposition.LOWER_BOUND:
-            alpha = max(alpha, transposition.get_entry().get_score())
+            alpha = max(alpha, score)
         elif transposition.get_flag() == data.Transposition.UPPER_BOUND:
-            beta = min(beta, transposition.get_entry().get_score())
+            beta = min(beta, score)
 
         if alpha >= beta:
-            return transposition.get_entry().get_score()
+            return score
 
     entry = data.Entry(chess.Move.null(), -math.inf)
 
-    if position.is_terminal():
-        if not position.get_player():
-            return -position.get_winner() * 10000
-        else:
-            return position.get_winner() * 10000
+    # Once few enough pieces are left the win/draw/loss result from the tablebase is exact
+    if TABLEBASE.can_probe(position):
+        wdl = TABLEBASE.probe_wdl(position)
+
+        if wdl is not None:
+            return wdl * TABLEBASE_WIN
 
+    in_check = state.is_check()
+
+    # Quiescence search doesn't generate evasions, so a mate on the horizon is found here
     if depth >= max_depth:
-        return qsearch(position, alpha, beta)
+        if in_check and not any(state.generate_legal_moves()):
+            return -MATE_SCORE + ply
+
+        return qsearch(position, alpha, beta, depth)
 
-    for move in position.get_actions():
-        position.get_state().push(move)
-        score = -negamax(position, -beta, -alpha, max_depth, depth=depth + 1)
-        position.get_state().pop()
+    remaining = max_depth - depth
+    pv_node = beta - alpha > PV_WINDOW
+
+    if NULL_MOVE and not pv_node and not in_check and remaining >= NULL_MOVE_MIN_DEPTH and beta < MATE_BOUND and \
+            state.move_stack and state.peek() and position.get_phase() < NULL_MOVE_MAX_PHASE and \
+            position.get_non_pawn_material(position.get_player()) and evaluate(position) >= beta:
+        position.push(chess.Move.null())
+        score = -negamax(position, -beta, -beta + SCOUT_WINDOW, max_depth - NULL_MOVE_REDUCTION, depth=depth + 1)
+        position.pop()
+
+        if stats is not None:
+            stats.null_move_cutoffs[ply] += score >= beta
 
         if score >= beta:
+            return beta if score >= MATE_BOUND else score
+
+    for i, move in enumerate(ordering.pick_actions(position, hash_move, depth)):
+        reduction = 0
+
+        if LMR and i >= LMR_MIN_MOVES and remaining >= LMR_MIN_DEPTH and not in_check and not move.promotion and \
+                not state.is_capture(move) and not state.gives_check(move):
+            reduction = LMR_REDUCTION + 1 if i >= LMR_LATE_MOVES else LMR_REDUCTION
+
+        position.push(move)
+
+        if i == 0:
+            score = -negamax(position, -beta, -alpha, max_depth, depth=depth + 1)
+        else:
+            lower = -alpha - SCOUT_WINDOW if PVS else -beta
+            score = -negamax(position, lower, -alpha, max_depth - reduction, depth=depth + 1)
+
+            if reduction and score > alpha:
+                score = -negamax(position, lower, -alpha, max_depth, depth=depth + 1)
+
+            if PVS and alpha < score < beta:
+                score = -negamax(position, -beta, -alpha, max_depth, depth=depth + 1)
+
+        position.pop()
+
+        if score >= beta:
+            TT.store(zhash, move, score_to_tt(score, ply), max_depth - depth, data.Transposition.LOWER_BOUND)
+
+            if stats is not None:
+                stats.tt_stores[ply] += 1
+                stats.cutoffs[ply] += 1
+                stats.first_move_cutoffs[ply] += i == 0
+
+            if not move.promotion and not position.get_state().is_capture(move):
+                ordering.store_cutoff(position, move, depth, max_depth - depth)
+
             return score
         if score > entry.get_score():
             entry.set_move(move)
@@ -58,47 +190,69 @@ def negamax(position, alpha, beta, max_depth, depth=0, searching=True):
         if score > alpha:
             alpha = score
 
-    if entry.get_score() > -math.inf:
-        new_transposition = data.Transposition(data.Transposition.EXACT, entry, depth)
+    # No legal moves: checkmate or stalemate
+    if entry.get_score() == -math.inf:
+        return -MATE_SCORE + ply if in_check else DRAW_SCORE
 
-        if entry.get_score() <= a:
-            new_transposition.set_flag(data.Transposition.UPPER_BOUND)
-        elif entry.get_score() >= beta:
-            new_transposition.set_flag(data.Transposition.LOWER_BOUND)
+    flag = data.Transposition.EXACT
 
-        TT.store(zhash, new_transposition)
+    if entry.get_score() <= a:
+        flag = data.Transposition.UPPER_BOUND
+    elif entry.get_score() >= beta:
+        flag = data.Transposition.LOWER_BOUND
+
+    TT.store(zhash, entry.get_move(), score_to_tt(entry.get_score(), ply), max_depth - depth, flag)
+
+    if stats is not None:
+        stats.tt_stores[ply] += 1
 
     return entry.get_score()
 
 
 # Searches all possible captures after negamax is done to prevent the horizon effect
 def qsearch(position, alpha, beta, depth=0, searching=True):
-    if position.is_terminal():
-        if not position.get_player():
-            return -position.get_winner() * 10000
-        else:
-            return position.get_winner() * 10000
+    INFO.nodes += 1
+    INFO.qnodes += 1
+
+    if not INFO.nodes & INFO.CHECK_MASK and INFO.is_stopped():
+        raise SearchTimeout()
+
+    state = position.get_state()
+    ply = depth + 1
 
-    evaluation = evaluate(position)
+    # A capture that mates is found here, as in negamax at the horizon (standing pat would miss it)
+    if state.is_check() and not any(state.generate_legal_moves()):
+        return -MATE_SCORE + ply
+
+    evaluation = evaluate(position, alpha, beta)
 
     if not searching:
         return evaluation
 
     zhash = position.get_zobrist_hash()
     a = alpha
+    stats = STATS
 
     transposition = TT.get(zhash)
 
-    if transposition.get_flag() != data.Transposition.NOT_PRESENT and transposition.get_depth() >= depth:
+    if stats is not None:
+        stats.qnodes[ply] += 1
+        stats.evaluations[ply] += 1
+        stats.tt_probes[ply] += 1
+        stats.tt_hits[ply] += transposition is not None
+
+    if transposition is not None:
+        score = score_from_tt(transposition.get_entry().get_score(), ply)
+
         if transposition.get_flag() == data.Transposition.EXACT:
-            return transposition.get_entry().get_score()
+            return score
         elif transposition.get_flag() == data.Transposition.LOWER_BOUND:
-            alpha = max(alpha, transposition.get_entry().get_score())
+            alpha = max(alpha, score)
         elif transposition.get_flag() == data.Transposition.UPPER_BOUND:
-            beta = min(beta, transposition.get_entry().get_score())
+            beta = min(beta, score)
 
         if alpha >= beta:
-            return transposition.get_entry().get_score()
+            return score
 
     if evaluation >= beta:
         return beta
@@ -107,13 +261,23 @@ def qsearch(position, alpha, beta, depth=0, searching=True):
         alpha = evaluation
 
     entry = data.Entry(chess.Move.null(), -math.inf)
+    delta_pruning = DELTA_PRUNING and position.get_phase() <= DELTA_MAX_PHASE
+
+    for i, (see, action) in enumerate(position.get_captures_by_see()):
+        if SEE_PRUNING and see < 0:
+            break
+        if delta_pruning and not action.promotion and evaluation + (see + DELTA_MARGIN) / 100 <= alpha:
+            continue
 
-    for action in position.get_captures():
-        position.get_state().push(action)
+        position.push(action)
         score = -qsearch(position, -beta, -alpha, depth + 1)
-        position.get_state().pop()
+        position.pop()
 
         if score >= beta:
+            if stats is not None:
+                stats.cutoffs[ply] += 1
+                stats.first_move_cutoffs[ply] += i == 0
+
             return beta
         if alpha < score:
             alpha = score
@@ -121,13 +285,88 @@ def qsearch(position, alpha, beta, depth=0, searching=True):
             entry.set_score(alpha)
 
     if entry.get_score() not in (-math.inf, math.inf):
-        new_transposition = data.Transposition(data.Transposition.EXACT, entry, depth)
+        flag = data.Transposition.EXACT
 
         if entry.get_score() <= a:
-            new_transposition.set_flag(data.Transposition.UPPER_BOUND)
+            flag = data.Transposition.UPPER_BOUND
         elif entry.get_score() >= beta:
-            new_transposition.set_flag(data.Transposition.LOWER_BOUND)
+            flag = data.Transposition.LOWER_BOUND
+
+        TT.store(zhash, entry.get_move(), score_to_tt(entry.get_score(), ply), 0, flag)
 
-        TT.store(zhash, new_transposition)
+        if stats is not None:
+            stats.tt_stores[ply] += 1
 
     return alpha
+
+
+# Mate scores are stored in the transposition table as distances from the node rather than from the root, so they
+# stay right when the position is reached at another ply
+def score_to_tt(score, ply):
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+
+    return score
+
+
+# Saves the transposition table to a snapshot file that load_tt can read in a later session
+def save_tt(path):
+    TT.save(path, get_zobrist_scheme(), get_evaluation_version())
+
+
+# Loads a snapshot saved by save_tt into the transposition table. Returns False (leaving the table as it is) if the
+# file is missing or was saved with other zobrist keys or another evaluation.
+def load_tt(path):
+    return TT.load(path, get_zobrist_scheme(), get_evaluation_version())
+
+
+# Merges snapshots (e.g. one from each worker process) into one file, keeping the deepest entries, and returns the
+# number of snapshots that could be used
+def merge_snapshots(paths, output, size_mb=data.TranspositionTable.DEFAULT_SIZE_MB):
+    table = data.TranspositionTable(size_mb)
+    scheme = get_zobrist_scheme()
+    evaluation = get_evaluation_version()
+    merged = sum(table.load(path, scheme, evaluation) for path in paths)
+
+    table.save(output, scheme, evaluation)
+
+    return merged
+
+
+# Starts (or with None, stops) collecting statistics into a data.SearchStats. With timing on, the functions the
+# search spends its time in are replaced by timed wrappers until statistics are stopped.
+def set_stats(stats):
+    global STATS
+
+    STATS = stats
+
+    for owner, name, function in TIMED_FUNCTIONS:
+        setattr(owner, name, function)
+
+    if stats is not None and stats.is_timing():
+        for owner, name, function in TIMED_FUNCTIONS:
+            setattr(owner, name, stats.timed(name, function))
+
+
+# (module or class, attribute, original function) of everything timed: evaluation, making and unmaking moves
+# (which update the hash and the accumulators), staged move generation and ordering in negamax, capture generation
+# with SEE in quiescence, and ordering of the evasions in check
+TIMED_FUNCTIONS = [
+    (sys.modules[__name__], "evaluate", evaluate),
+    (Position, "push", Position.push),
+    (Position, "pop", Position.pop),
+    (ordering, "pick_actions", ordering.pick_actions),
+    (Position, "get_captures_by_see", Position.get_captures_by_see),
+    (ordering, "order_actions", ordering.order_actions)
+]
@@ -0,0 +1,420 @@
+# Chess v3.2.0 Service
+# --------------------------------------------------------------
+# Headless JSON move API: an asyncio HTTP server that hands searches to a pool of warm engine processes
+# --------------------------------------------------------------
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import threading
+from collections import deque
+
+import chess
+
+from red_chess import engine, search
+from red_chess.position import Position
+
+HOST = "localhost"
+PORT = 8080
+
+# Engine processes. Each one keeps its transposition table and opened books between requests.
+WORKERS = 2
+
+# Requests waiting for a worker or being searched before new ones are turned away with 503
+MAX_QUEUE = 16
+
+# Seconds per search when the request doesn't give a move time, and the most a request may ask for
+DEFAULT_MOVETIME = 1.0
+MAX_MOVETIME = 30.0
+
+MAX_BODY = 65536
+
+# Workers search the expected reply to their last move while idle, for at most MAX_MOVETIME
+PONDER = True
+
+STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    503: "Service Unavailable"
+}
+
+
+# Runs in each engine process: searches every task it is sent and puts the result on the shared results queue.
+# Setting the stop event ends the current search early with the best move found so far.
+def worker_loop(tasks, results, stop_event, ponder=PONDER):
+    search.INFO.set_stop_event(stop_event)
+    ponder = engine.Ponder(threads=1) if ponder else None
+
+    while True:
+        task = tasks.get()
+
+        if task is None:
+            if ponder is not None:
+                ponder.stop()
+
+            break
+
+        request, fen, moves, depth, movetime, book = task
+        position = Position(chess.Board(fen))
+
+        for move in moves:
+            position.push(chess.Move.from_uci(move))
+
+        results.put((request, search_position(position, depth, movetime, book, ponder)))
+
+
+# Returns the response to a move request for a position. With a Ponder, the result of the search pondered on this
+# position is used if there is one, and the expected reply to the move found ("ponder" in the response) is pondered
+# on next.
+def search_position(position, depth, movetime, book, ponder=None):
+    state = position.get_state()
+    best = None
+
+    if ponder is not None:
+        best = ponder.finish(position, depth, movetime)
+
+    if state.is_game_over():
+        return {"move": None, "result": state.result()}
+
+    if book and best is None:
+        action = engine.book_action(position)
+
+        if action:
+            return {"move": action.uci(), "book": True}
+
+    response = {}
+
+    if best is not None:
+        response["ponderhit"] = True
+    else:
+        best = engine.get_best_action(position, depth, movetime=movetime, threads=1)
+
+    # A search stopped before its first iteration has no score (and JSON has no infinity)
+    response.update({
+        "move": best.get_move().uci(),
+        "score": best.get_score() if math.isfinite(best.get_score()) else None,
+        "depth": search.INFO.get_depth(),
+        "nodes": search.INFO.get_nodes(),
+        "time": round(search.INFO.get_elapsed(), 3)
+    })
+
+    if ponder is not None:
+        position.push(best.get_move())
+        action = ponder.start(position, depth, MAX_MOVETIME)
+        position.pop()
+
+        if action is not None:
+            response["ponder"] = action.uci()
+
+    return response
+
+
+# Represents the engine processes, started (and warmed up with a short search) before any request comes in.
+# Requests take an idle worker in arrival order, preferring the one pondering on their position, and a cancelled
+# request stops its search so the worker frees up.
+class EnginePool:
+
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE):
+        context = multiprocessing.get_context()
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.requests = 0
+        self.futures = {}
+        self.loop = None
+        self.idle = []
+        self.waiting = deque()
+        self.pondering = [None] * workers
+        self.results = context.Queue()
+        self.tasks = [context.Queue() for i in range(workers)]
+        self.stop_events = [context.Event() for i in range(workers)]
+        self.processes = [
+            context.Process(target=worker_loop, args=(self.tasks[i], self.results, self.stop_events[i]), daemon=True)
+            for i in range(workers)
+        ]
+
+        for process in self.processes:
+            process.start()
+
+    def get_workers(self):
+        return self.workers
+
+    def get_pending(self):
+        return self.pending
+
+    def get_max_queue(self):
+        return self.max_queue
+
+    def is_full(self):
+        return self.pending >= self.max_queue
+
+    # Starts delivering results to the event loop and waits for every worker to finish a warm up search
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.read_results, daemon=True).start()
+
+        await asyncio.gather(*(self.run(i, (chess.STARTING_FEN, [], 1, None, False)) for i in range(self.workers)))
+
+        for i in range(self.workers):
+            self.release(i)
+
+    # Runs in a thread: hands each result to the event loop
+    def read_results(self):
+        while True:
+            result = self.results.get()
+
+            if result is None:
+                break
+
+            self.loop.call_soon_threadsafe(self.resolve, *result)
+
+    def resolve(self, request, result):
+        future = self.futures.pop(request, None)
+
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    # Searches a position on the next idle worker
+    async def search(self, fen, moves, depth, movetime, book):
+        self.pending += 1
+
+        try:
+            worker = await self.acquire((fen, tuple(moves)))
+            self.pondering[worker] = None
+
+            try:
+                result = await self.run(worker, (fen, moves, depth, movetime, book))
+            finally:
+                self.release(worker)
+
+            if "ponder" in result:
+                self.pondering[worker] = (fen, (*moves, result["move"], result["ponder"]))
+
+            return result
+        finally:
+            self.pending -= 1
+
+    # Takes the idle worker pondering on the position (a (fen, moves) pair) if there is one, else the first idle
+    # worker, else waits for one
+    async def acquire(self, position):
+        if self.idle:
+            worker = next((worker for worker in self.idle if self.pondering[worker] == position), self.idle[0])
+            self.idle.remove(worker)
+
+            return worker
+
+        waiter = self.loop.create_future()
+        self.waiting.append(waiter)
+
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # Cancelled after a worker was handed over, so pass it on
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result())
+
+            raise
+
+    # Hands a worker to the longest waiting request, or returns it to the idle workers
+    def release(self, worker):
+        while self.waiting:
+            waiter = self.waiting.popleft()
+
+            if not waiter.done():
+                waiter.set_result(worker)
+                return
+
+        self.idle.append(worker)
+
+    async def run(self, worker, task):
+        self.requests += 1
+        request = self.requests
+        future = self.loop.create_future()
+        self.futures[request] = future
+
+        self.stop_events[worker].clear()
+        self.tasks[worker].put((request, *task))
+
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Stop the search and wait for it so the worker is idle before it takes the next request
+            self.stop_events[worker].set()
+            await future
+            raise
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+
+        for process in self.processes:
+            process.join(5)
+
+        self.results.put(None)
+
+
+# Represents the HTTP server. POST /move takes {"fen", "moves", "movetime", "depth", "book"} (all optional) and
+# returns the best move, score, depth and nodes, and the expected reply. GET /status returns the queue depth.
+class MoveServer:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def serve(self, host=HOST, port=PORT):
+        await self.pool.start()
+        server = await asyncio.start_server(self.handle, host, port)
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, body = await read_request(reader)
+                response = await self.respond(method, path, body, reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                response = (400, {"error": "malformed request"})
+
+            # None means the client went away and its search was cancelled
+            if response is not None:
+                status, content = response
+                content = json.dumps(content).encode()
+
+                writer.write(("HTTP/1.1 " + str(status) + " " + STATUS[status] + "\r\n" +
+                              "Content-Type: application/json\r\n" +
+                              "Content-Length: " + str(len(content)) + "\r\n" +
+                              "Connection: close\r\n\r\n").encode() + content)
+
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, path, body, reader):
+        if path == "/status":
+            return 200, {"workers": self.pool.get_workers(), "pending": self.pool.get_pending(),
+                         "max_queue": self.pool.get_max_queue()}
+        if path != "/move":
+            return 404, {"error": "not found"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        if len(body) > MAX_BODY:
+            return 413, {"error": "request too large"}
+
+        try:
+            fen, moves, depth, movetime, book = parse_move_request(body)
+        except (ValueError, TypeError) as error:
+            return 400, {"error": str(error)}
+
+        if self.pool.is_full():
+            return 503, {"error": "too many requests"}
+
+        searching = asyncio.ensure_future(self.pool.search(fen, moves, depth, movetime, book))
+
+        while True:
+            closed = asyncio.ensure_future(reader.read(1))
+            done, waiting = await asyncio.wait({searching, closed}, return_when=asyncio.FIRST_COMPLETED)
+
+            if searching in done:
+                closed.cancel()
+
+                return 200, searching.result()
+
+            if not closed.result():
+                searching.cancel()
+
+                try:
+                    await searching
+                except asyncio.CancelledError:
+                    pass
+
+                return None
+
+
+# Reads the request line, headers and body of an HTTP request
+async def read_request(reader):
+    method, path, version = (await reader.readline()).decode("latin-1").split()
+    headers = {}
+
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+
+        if not line:
+            break
+
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(min(length, MAX_BODY + 1)) if length else b""
+
+    return method, path, body
+
+
+# Checks a move request and returns (fen, moves, depth, movetime, book). Raises ValueError if it isn't valid.
+def parse_move_request(body):
+    request = json.loads(body or b"{}")
+
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+
+    fen = request.get("fen", chess.STARTING_FEN)
+    moves = request.get("moves", [])
+
+    if not isinstance(fen, str) or not isinstance(moves, list) or not all(isinstance(move, str) for move in moves):
+        raise ValueError("fen must be a string and moves a list of strings")
+
+    board = chess.Board(fen)
+
+    if not board.is_valid():
+        raise ValueError("invalid position")
+
+    for move in moves:
+        board.push(board.parse_uci(move))
+
+    depth = request.get("depth") or engine.MAX_DEPTH
+
+    if not isinstance(depth, (int, float)) or not math.isfinite(depth):
+        raise ValueError("depth must be a number")
+
+    depth = int(depth)
+    movetime = request.get("movetime")
+    movetime = DEFAULT_MOVETIME if movetime is None else min(float(movetime), MAX_MOVETIME)
+
+    # Written so NaN (which JSON parsing accepts) fails too
+    if not 1 <= depth <= engine.MAX_DEPTH or not 0 < movetime <= MAX_MOVETIME:
+        raise ValueError("depth must be from 1 to " + str(engine.MAX_DEPTH) + " and movetime positive")
+
+    return board.root().fen(), [move.uci() for move in board.move_stack], depth, movetime, bool(request.get("book"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON move API")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE)
+
+    args = parser.parse_args()
+
+    # The workers are started before the event loop and its threads exist
+    pool = EnginePool(args.workers, args.max_queue)
+
+    try:
+        asyncio.run(MoveServer(pool).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
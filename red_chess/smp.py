@@ -0,0 +1,361 @@
+# Chess v3.2.0 SMP
+# --------------------------------------------------------------
+# Parallel search. Lazy SMP: worker processes search the same root and share one transposition table in shared
+# memory. Root splitting: the root moves are searched in a process pool, with the same result as a serial search
+# without late-move reductions.
+# --------------------------------------------------------------
+
+import atexit
+import math
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import chess
+import numpy as np
+
+from red_chess import data, engine, ordering, search
+from red_chess.position import Position
+
+# Size of the shared transposition table
+HASH_SIZE = data.TranspositionTable.DEFAULT_SIZE_MB
+
+# Size of the private transposition table of each root splitting worker
+SPLIT_HASH_SIZE = 16
+
+# Late-move reductions in root splitting workers (see RootSplit)
+SPLIT_LMR = False
+
+# Seconds between checks for a stopped search while waiting for the workers
+POLL_INTERVAL = 0.05
+
+POOL = None
+SPLIT_POOL = None
+
+
+# Returns the shared pool, restarting it if the worker count changed
+def get_pool(workers):
+    global POOL
+
+    if POOL is None or POOL.get_workers() != workers:
+        if POOL is not None:
+            POOL.close()
+
+        POOL = LazySMP(workers, HASH_SIZE)
+        atexit.register(POOL.close)
+
+    return POOL
+
+
+# Sets the size of the shared transposition table, restarting the pool on its next use
+def set_hash_size(size_mb):
+    global HASH_SIZE, POOL
+
+    HASH_SIZE = size_mb
+
+    if POOL is not None:
+        POOL.close()
+        POOL = None
+
+
+# Returns the shared root splitting pool, restarting it if the worker count changed
+def get_split_pool(workers):
+    global SPLIT_POOL
+
+    if SPLIT_POOL is None or SPLIT_POOL.get_workers() != workers:
+        if SPLIT_POOL is not None:
+            SPLIT_POOL.close()
+
+        SPLIT_POOL = RootSplit(workers)
+        atexit.register(SPLIT_POOL.close)
+
+    return SPLIT_POOL
+
+
+# Runs in each worker process: attaches to the shared table and searches every root it is sent
+def worker_loop(worker, memory_name, tasks, results, stop_event):
+    memory = shared_memory.SharedMemory(name=memory_name)
+    search.TT.attach(memory.buf)
+    search.INFO.set_stop_event(stop_event)
+
+    def report(depth, entry):
+        results.put(("iteration", worker, depth, entry.get_move().uci(), entry.get_score(), search.INFO.get_nodes()))
+
+    while True:
+        task = tasks.get()
+
+        if task is None:
+            break
+
+        fen, moves, depth, budget, age = task
+        position = Position(chess.Board(fen))
+
+        for move in moves:
+            position.push(chess.Move.from_uci(move))
+
+        search.TT.set_age(age - 1)
+
+        # Odd helpers skip the first iteration so the workers spread over two depths
+        engine.iterative_deepening(position, depth, budget, start_depth=1 + worker % 2,
+                                   seed=worker if worker else None, report=report)
+
+        results.put(("done", worker, search.INFO.get_depth(), None, None, search.INFO.get_nodes()))
+
+    search.TT.resize(1)
+    memory.close()
+
+
+# Represents a set of worker processes kept alive between searches, with their shared transposition table
+class LazySMP:
+
+    def __init__(self, workers, size_mb=HASH_SIZE):
+        context = multiprocessing.get_context()
+
+        self.workers = workers
+        self.age = 0
+        self.memory = shared_memory.SharedMemory(create=True, size=data.TranspositionTable.get_table_bytes(size_mb))
+        self.table = data.TranspositionTable(1)
+        self.table.attach(self.memory.buf)
+        self.results = context.Queue()
+        self.stop_event = context.Event()
+        self.tasks = [context.Queue() for i in range(workers)]
+        self.processes = [
+            context.Process(target=worker_loop, args=(i, self.memory.name, self.tasks[i], self.results,
+                                                      self.stop_event), daemon=True)
+            for i in range(workers)
+        ]
+
+        for process in self.processes:
+            process.start()
+
+    def get_workers(self):
+        return self.workers
+
+    # The shared table as seen from this process, for reading principal variations
+    def get_table(self):
+        return self.table
+
+    # Searches the position with every worker and returns the best move of the deepest completed iteration.
+    # Once a worker completes the requested depth (or the time budget runs out, or search.INFO is stopped from
+    # another thread) the others are stopped.
+    def search(self, position, depth, budget=None, report=None):
+        state = position.get_state()
+        root = state.root()
+        moves = [move.uci() for move in state.move_stack]
+        deadline = math.inf if budget is None else time.perf_counter() + budget
+        best = data.Entry(position.get_actions()[0], -math.inf)
+        best_depth = 0
+        nodes = [0] * self.workers
+        running = self.workers
+
+        self.age = (self.age + 1) % data.TranspositionTable.MAX_AGE
+        self.stop_event.clear()
+        search.INFO.start(deadline)
+
+        for tasks in self.tasks:
+            tasks.put((root.fen(), moves, depth, budget, self.age))
+
+        while running:
+            try:
+                kind, worker, completed, move, score, worker_nodes = self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if search.INFO.is_stopped():
+                    self.stop_event.set()
+
+                continue
+
+            nodes[worker] = worker_nodes
+            search.INFO.set_nodes(sum(nodes))
+
+            if kind == "done":
+                running -= 1
+            elif completed > best_depth:
+                best = data.Entry(chess.Move.from_uci(move), score)
+                best_depth = completed
+
+                if report is not None:
+                    report(completed, best)
+
+            if completed >= depth:
+                self.stop_event.set()
+
+        search.INFO.set_depth(best_depth)
+        search.INFO.set_nodes(sum(nodes))
+
+        return best
+
+    # Empties the shared transposition table (only while no search is running)
+    def clear(self):
+        table = np.ndarray(self.memory.size, np.uint8, self.memory.buf)
+        table.fill(0)
+        del table
+
+    def close(self):
+        if self.memory is None:
+            return
+
+        for tasks in self.tasks:
+            tasks.put(None)
+
+        for process in self.processes:
+            process.join(5)
+
+        # Let go of the buffer first, the memory can't be closed while it's in use
+        self.table.resize(1)
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+
+def split_worker_init(size_mb, stop_event):
+    search.TT.resize(size_mb)
+    search.INFO.set_stop_event(stop_event)
+    search.LMR = SPLIT_LMR
+
+
+# Runs in a root splitting worker: searches one root move of the position given as FEN plus move stack with the
+# window and returns its score and node count, or None if the search was stopped. The table, killers and history
+# are cleared first and filled by searching the move from depth 1 up, so the result only depends on the arguments
+# and not on which root moves the worker searched before.
+def search_root_move(fen, moves, action, depth, alpha, beta):
+    position = Position(chess.Board(fen))
+
+    for move in moves:
+        position.push(chess.Move.from_uci(move))
+
+    search.TT.clear()
+    ordering.clear()
+    search.INFO.start()
+
+    position.push(chess.Move.from_uci(action))
+
+    try:
+        for d in range(1, depth):
+            search.negamax(position, -math.inf, math.inf, d - 1)
+
+        score = -search.negamax(position, -beta, -alpha, depth - 1)
+    except search.SearchTimeout:
+        return None
+
+    return score, search.INFO.get_nodes()
+
+
+# Represents a process pool that searches the root moves of each iteration in parallel. As in the serial root
+# search, the first move (the previous iteration's best) is searched with the full window, then the others with a
+# null window above its score, now all at once, and the ones that beat it again with the window above it. The best
+# move is the first one in root order with the highest score. The workers search without late-move reductions,
+# which depend on the killers and history left by the other root moves, and give the same move and score as the
+# serial search with search.LMR off (bench.py split checks this).
+class RootSplit:
+
+    def __init__(self, workers, size_mb=SPLIT_HASH_SIZE):
+        context = multiprocessing.get_context()
+
+        self.workers = workers
+        self.stop_event = context.Event()
+        self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=split_worker_init,
+                                            initargs=(size_mb, self.stop_event))
+
+    def get_workers(self):
+        return self.workers
+
+    def search(self, position, depth, budget=None, report=None):
+        state = position.get_state()
+        fen = state.root().fen()
+        moves = [move.uci() for move in state.move_stack]
+        actions = ordering.order_actions(position, position.get_actions())
+        best = data.Entry(actions[0], -math.inf)
+        deadline = math.inf if budget is None else time.perf_counter() + budget
+        nodes = 0
+
+        self.stop_event.clear()
+        search.INFO.start(deadline)
+
+        for d in range(1, depth + 1):
+            result = self.search_root(fen, moves, actions, d)
+
+            if result is None:
+                break
+
+            best, iteration_nodes = result
+            nodes += iteration_nodes
+
+            search.INFO.set_depth(d)
+            search.INFO.set_nodes(nodes)
+
+            if report is not None:
+                report(d, best)
+
+            actions.remove(best.get_move())
+            actions.insert(0, best.get_move())
+
+            if abs(best.get_score()) >= search.MATE_BOUND:
+                break
+
+            # The next iteration takes several times longer, so don't start it if it's unlikely to finish
+            if budget is not None and search.INFO.get_elapsed() > budget / 2:
+                break
+
+        return best
+
+    # Searches every root move to a depth and returns the best one with the nodes searched, or None if search.INFO
+    # was stopped (or its deadline passed) first
+    def search_root(self, fen, moves, actions, depth):
+        results = self.run_tasks(fen, moves, depth, [(actions[0], -math.inf, math.inf)])
+
+        if results is None:
+            return None
+
+        alpha, nodes = results[0]
+        best = data.Entry(actions[0], alpha)
+        results = self.run_tasks(fen, moves, depth, [(action, alpha, alpha + search.SCOUT_WINDOW)
+                                                     for action in actions[1:]])
+
+        if results is None:
+            return None
+
+        nodes += sum(action_nodes for score, action_nodes in results)
+        better = [action for action, (score, action_nodes) in zip(actions[1:], results) if score > alpha]
+        results = self.run_tasks(fen, moves, depth, [(action, alpha, math.inf) for action in better])
+
+        if results is None:
+            return None
+
+        for action, (score, action_nodes) in zip(better, results):
+            nodes += action_nodes
+
+            if score > best.get_score():
+                best = data.Entry(action, score)
+
+        return best, nodes
+
+    # Searches each (move, alpha, beta) task in the pool and returns the results in the same order, or None if
+    # search.INFO was stopped first, in which case the workers are stopped too
+    def run_tasks(self, fen, moves, depth, tasks):
+        futures = [self.executor.submit(search_root_move, fen, moves, action.uci(), depth, alpha, beta)
+                   for action, alpha, beta in tasks]
+        waiting = set(futures)
+
+        while waiting:
+            done, waiting = wait(waiting, timeout=POLL_INTERVAL)
+
+            if waiting and search.INFO.is_stopped():
+                for future in waiting:
+                    future.cancel()
+
+                self.stop_event.set()
+                wait(waiting)
+                self.stop_event.clear()
+
+                return None
+
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.executor is None:
+            return
+
+        self.executor.shutdown()
+        self.executor = None
@@ -0,0 +1,128 @@
+# Chess v3.2.0 Tablebase
+# --------------------------------------------------------------
+# Endgame tablebase probing with the win/draw/loss and distance to mate results cached by Zobrist hash
+# --------------------------------------------------------------
+
+import os
+from collections import OrderedDict
+
+import chess
+from chess import gaviota
+
+# Used for the endgame tablebase (change filepath or call Tablebase.open for a custom tablebase)
+TABLEBASE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "endgames", "gaviota_3", "gtb")
+
+# Positions with more pieces (kings included) than the tables cover are never probed
+MAX_PIECES = 3
+
+# Number of results kept in each cache before the least recently used ones are dropped
+CACHE_SIZE = 65536
+
+
+# Represents an opened tablebase. Every probe reads the tables from disk, so results (including missing tables,
+# cached as None) are kept in least recently used caches keyed by the Zobrist hash of the position.
+class Tablebase:
+
+    def __init__(self, directory=TABLEBASE_DIRECTORY, max_pieces=MAX_PIECES, cache_size=CACHE_SIZE):
+        self.tablebase = None
+        self.directory = None
+        self.max_pieces = max_pieces
+        self.cache_size = cache_size
+        self.wdl_cache = OrderedDict()
+        self.dtm_cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            self.open(directory)
+
+    def __str__(self):
+        return "Tablebase(" + str(self.directory) + ", " + str(self.max_pieces) + " pieces)"
+
+    # Opens the tables in a directory instead of the current ones (no tablebase if it can't be opened)
+    def open(self, directory, max_pieces=None):
+        self.close()
+
+        if max_pieces is not None:
+            self.max_pieces = max_pieces
+
+        try:
+            self.tablebase = gaviota.open_tablebase(directory)
+            self.directory = directory
+        except OSError:
+            self.tablebase = None
+            self.directory = None
+
+    def close(self):
+        if self.tablebase is not None:
+            self.tablebase.close()
+
+        self.tablebase = None
+        self.directory = None
+        self.clear()
+
+    def clear(self):
+        self.wdl_cache.clear()
+        self.dtm_cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def is_open(self):
+        return self.tablebase is not None
+
+    def get_directory(self):
+        return self.directory
+
+    def get_max_pieces(self):
+        return self.max_pieces
+
+    def get_hits(self):
+        return self.hits
+
+    def get_misses(self):
+        return self.misses
+
+    # Cheap test done before every probe: few enough pieces and no castling rights
+    def can_probe(self, position):
+        state = position.get_state()
+
+        return (self.tablebase is not None and chess.popcount(state.occupied) <= self.max_pieces and
+                not state.castling_rights)
+
+    # Returns 1 if the side to move wins, 0 on a draw, -1 if it loses, or None if the position isn't in the tables
+    def probe_wdl(self, position):
+        if self.tablebase is None:
+            return None
+
+        return self.probe(position, self.wdl_cache, self.tablebase.probe_wdl)
+
+    # Returns the number of plies to mate (positive if the side to move mates, negative if it gets mated, 0 on a draw
+    # or mate), or None if the position isn't in the tables
+    def probe_dtm(self, position):
+        if self.tablebase is None:
+            return None
+
+        return self.probe(position, self.dtm_cache, self.tablebase.probe_dtm)
+
+    def probe(self, position, cache, probe):
+        key = position.get_zobrist_hash()
+
+        if key in cache:
+            self.hits += 1
+            cache.move_to_end(key)
+
+            return cache[key]
+
+        self.misses += 1
+
+        try:
+            result = probe(position.get_state())
+        except KeyError:
+            result = None
+
+        cache[key] = result
+
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+        return result
@@ -0,0 +1,293 @@
+# Chess v3.2.0 UCI
+# --------------------------------------------------------------
+# Universal Chess Interface front end so the engine can run headless under a GUI or a match runner
+# --------------------------------------------------------------
+
+import sys
+import threading
+import time
+
+import chess
+
+from red_chess import data, engine, ordering, search, smp
+from red_chess.position import Position
+
+NAME = "Red Chess 3.2.0"
+AUTHOR = "sathvikr"
+
+# Options as UCI option declarations
+OPTIONS = [
+    "option name Hash type spin default " + str(data.TranspositionTable.DEFAULT_SIZE_MB) + " min 1 max 65536",
+    "option name Threads type spin default " + str(engine.THREADS) + " min 1 max 256",
+    "option name SplitMode type combo default " + engine.MODE + " var smp var split",
+    "option name OwnBook type check default false",
+    "option name Ponder type check default false",
+    "option name GaviotaTbPath type string default <empty>",
+    "option name Clear Hash type button"
+]
+
+
+# Represents a UCI session: reads commands, keeps the current position and runs each search in a background thread
+# so stop (or quit) is answered while the engine is thinking
+class UCI:
+
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.lock = threading.Lock()
+        self.position = Position()
+        self.thread = None
+        self.stopped = threading.Event()
+        self.own_book = False
+        self.ponder_start = None
+        self.ponder_budget = None
+        self.deadline = None
+
+    def send(self, line):
+        with self.lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    # Runs until quit or the end of the input
+    def loop(self, commands=sys.stdin):
+        for line in commands:
+            if not self.command(line):
+                break
+
+        self.stop()
+
+    # Handles one command and returns False on quit
+    def command(self, line):
+        tokens = line.split()
+
+        if not tokens:
+            return True
+
+        name, arguments = tokens[0], tokens[1:]
+
+        if name == "uci":
+            self.send("id name " + NAME)
+            self.send("id author " + AUTHOR)
+
+            for option in OPTIONS:
+                self.send(option)
+
+            self.send("uciok")
+        elif name == "isready":
+            self.send("readyok")
+        elif name == "ucinewgame":
+            self.stop()
+            self.clear_hash()
+        elif name == "setoption":
+            self.stop()
+            self.set_option(arguments)
+        elif name == "position":
+            self.stop()
+            self.set_position(arguments)
+        elif name == "go":
+            self.stop()
+            self.go(arguments)
+        elif name == "ponderhit":
+            self.ponder_hit()
+        elif name == "stop":
+            self.stop()
+        elif name == "quit":
+            return False
+
+        return True
+
+    # setoption name <name> value <value>
+    def set_option(self, arguments):
+        if "name" not in arguments:
+            return
+
+        if "value" in arguments:
+            name = " ".join(arguments[arguments.index("name") + 1:arguments.index("value")]).lower()
+            value = " ".join(arguments[arguments.index("value") + 1:])
+        else:
+            name = " ".join(arguments[arguments.index("name") + 1:]).lower()
+            value = ""
+
+        # Sizes and counts that aren't positive integers are ignored
+        if name in ("hash", "threads") and (not value.isdigit() or int(value) < 1):
+            return
+
+        if name == "hash":
+            search.TT.resize(int(value))
+            smp.set_hash_size(int(value))
+            self.start_pool()
+        elif name == "threads":
+            engine.THREADS = int(value)
+            self.start_pool()
+        elif name == "splitmode":
+            engine.MODE = value
+            self.start_pool()
+        elif name == "ownbook":
+            self.own_book = value.lower() == "true"
+        elif name == "gaviotatbpath":
+            if value and value != "<empty>":
+                search.TABLEBASE.open(value)
+            else:
+                search.TABLEBASE.close()
+        elif name == "clear hash":
+            self.clear_hash()
+
+    # Empties the transposition table the next search uses (the one shared by the Lazy SMP workers when there are
+    # several) along with the killers and history
+    def clear_hash(self):
+        search.TT.clear()
+        ordering.clear()
+
+        if engine.THREADS > 1 and engine.MODE != "split":
+            smp.get_pool(engine.THREADS).clear()
+
+    # Starts the worker processes now rather than on the first go, so their start up isn't taken from the clock
+    def start_pool(self):
+        if engine.THREADS > 1 and engine.MODE == "split":
+            smp.get_split_pool(engine.THREADS)
+        elif engine.THREADS > 1:
+            smp.get_pool(engine.THREADS)
+
+    # position [startpos | fen <fen>] [moves <move>...]. An invalid FEN leaves the position as it was, and the moves
+    # are played up to the first one that isn't legal.
+    def set_position(self, arguments):
+        moves = arguments.index("moves") if "moves" in arguments else len(arguments)
+
+        try:
+            if arguments and arguments[0] == "fen":
+                board = chess.Board(" ".join(arguments[1:moves]))
+            else:
+                board = chess.Board()
+        except ValueError:
+            return
+
+        self.position = Position(board)
+
+        for move in arguments[moves + 1:]:
+            try:
+                action = self.position.get_state().parse_uci(move)
+            except ValueError:
+                break
+
+            self.position.push(action)
+
+    # go [depth <plies>] [movetime <ms>] [wtime <ms>] [btime <ms>] [winc <ms>] [binc <ms>] [movestogo <moves>]
+    # [infinite] [ponder]. Limits without an integer value are ignored.
+    def go(self, arguments):
+        limits = {}
+
+        for i, token in enumerate(arguments[:-1]):
+            if token in ("depth", "movetime", "wtime", "btime", "winc", "binc", "movestogo"):
+                try:
+                    limits[token] = int(arguments[i + 1])
+                except ValueError:
+                    pass
+
+        white = self.position.get_player() == chess.WHITE
+        clock = limits.get("wtime" if white else "btime")
+        increment = limits.get("winc" if white else "binc", 0)
+        movetime = limits.get("movetime")
+        infinite = "infinite" in arguments
+        ponder = "ponder" in arguments
+
+        budget = None
+
+        if not infinite:
+            budget = engine.get_time_budget(None if movetime is None else movetime / 1000,
+                                            None if clock is None else clock / 1000, increment / 1000,
+                                            limits.get("movestogo", engine.MOVES_TO_GO))
+
+        # Pondering searches without a time limit until ponderhit gives it the budget
+        self.ponder_start = time.perf_counter()
+        self.ponder_budget = budget
+        self.deadline = None
+
+        if ponder:
+            budget = None
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.search, daemon=True,
+                                       args=(limits.get("depth", engine.MAX_DEPTH), budget, infinite or ponder))
+        self.thread.start()
+
+    # The expected move was played: the ponder search goes on as a normal search, with the time spent pondering
+    # counted against its budget
+    def ponder_hit(self):
+        if self.ponder_budget is not None:
+            self.deadline = self.ponder_start + self.ponder_budget
+            search.INFO.set_deadline(self.deadline)
+
+        self.stopped.set()
+
+    # Runs in the search thread and answers with bestmove and the expected reply (after stop or ponderhit when
+    # searching infinitely or pondering)
+    def search(self, depth, budget, infinite):
+        position = self.position.copy()
+        action = None
+
+        if self.own_book:
+            action = engine.book_action(position)
+
+        if not action:
+            action = engine.mate_n(position)
+            action = action.get_move() if action is not None else None
+
+        if not action and position.get_actions():
+            action = engine.get_best_action(position, depth, movetime=budget, report=self.report).get_move()
+
+        if infinite:
+            self.stopped.wait()
+
+        if not action:
+            self.send("bestmove 0000")
+            return
+
+        position.push(action)
+        reply = engine.get_expected_action(position)
+
+        self.send("bestmove " + action.uci() + (" ponder " + reply.uci() if reply else ""))
+
+    # Prints an info line after every completed iteration
+    def report(self, depth, entry):
+        # The search resets the deadline when it starts, which may be after a ponderhit
+        if self.deadline is not None:
+            search.INFO.set_deadline(self.deadline)
+
+        position = self.position.copy()
+        elapsed = search.INFO.get_elapsed()
+        nodes = search.INFO.get_nodes()
+        pv = engine.get_pv(position, entry.get_move(), depth) or [entry.get_move()]
+
+        self.send("info depth " + str(depth) + " score " + format_score(entry.get_score()) + " nodes " +
+                  str(nodes) + " nps " + str(int(nodes / elapsed) if elapsed else 0) + " time " +
+                  str(int(elapsed * 1000)) + " pv " + " ".join(action.uci() for action in pv))
+
+    # Stops the running search and waits for its bestmove
+    def stop(self):
+        self.stopped.set()
+
+        while self.thread is not None and self.thread.is_alive():
+            search.INFO.stop()
+            self.thread.join(0.01)
+
+        self.thread = None
+
+
+# Converts a score in pawns from the side to move's perspective to a UCI score
+def format_score(score):
+    if abs(score) >= search.MATE_BOUND:
+        moves = (search.MATE_SCORE - abs(score) + 1) // 2
+
+        return "mate " + str(moves if score > 0 else -moves)
+
+    return "cp " + str(round(score * 100))
+
+
+# Commands are read through a separate file object on standard input: worker processes forked while the main
+# thread is blocked reading would otherwise hang closing sys.stdin, whose lock that read holds
+def main():
+    with open(sys.stdin.fileno(), encoding="utf-8", closefd=False) as commands:
+        UCI().loop(commands)
+
+
+if __name__ == "__main__":
+    main()